@@ -0,0 +1,217 @@
+"""Benchmarks for the NB-IoT client, run offline against nbiot.fakeserver.
+
+	python benchmarks/bench.py [--quick] [--output results.json]
+
+The results are written as JSON: one record per measurement with its name,
+unit and value, so runs from different releases can be compared."""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from nbiot import decoders
+from nbiot import nbiot
+from nbiot.fakeserver import FakeServer
+
+def bench_import(server, args):
+	"""Time to import nbiot.nbiot in a fresh interpreter."""
+	code = 'import time; t = time.perf_counter(); import nbiot.nbiot; print(time.perf_counter() - t)'
+	root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+	times = []
+	for _ in range(5):
+		out = subprocess.run([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE, check=True).stdout
+		times.append(float(out))
+	return [result('import.median', 'ms', median(times) * 1e3)]
+
+def bench_request(server, args):
+	"""Latency of Client._request on a fresh connection versus a reused one."""
+	n = args.requests
+	cold = []
+	for _ in range(n):
+		client = nbiot.Client(addr=server.addr, token=server.token)
+		client.close()
+		t = time.perf_counter()
+		client._request('GET', '/system')
+		cold.append(time.perf_counter() - t)
+		client.close()
+
+	warm = []
+	with nbiot.Client(addr=server.addr, token=server.token) as client:
+		for _ in range(n):
+			t = time.perf_counter()
+			client._request('GET', '/system')
+			warm.append(time.perf_counter() - t)
+	return [
+		result('request.cold.median', 'us', median(cold) * 1e6),
+		result('request.reused.median', 'us', median(warm) * 1e6),
+	]
+
+def bench_list_decoding(server, args):
+	"""Cost of turning large devices() and outputs() responses into models."""
+	n = args.items
+	with nbiot.Client(addr=server.addr, token=server.token) as client:
+		collection = client.create_collection(nbiot.Collection())
+		client.create_devices(collection.id, [nbiot.Device(imsi=str(i), imei=str(i), tags={'n': str(i)}) for i in range(n)], workers=16)
+		for i in range(n):
+			server.outputs['o{0}'.format(i)] = nbiot.WebHookOutput(
+				id='o{0}'.format(i), collection_id=collection.id, url='http://example.com/', enabled=True,
+			).json()
+
+		results = []
+		for name, path, key, decode in [
+			('devices', '/collections/{0}/devices', 'devices', lambda d: nbiot.Device(json=d)),
+			('outputs', '/collections/{0}/outputs', 'outputs', nbiot._output),
+		]:
+			path = path.format(collection.id)
+			t = time.perf_counter()
+			x = client._request('GET', path)
+			fetch = time.perf_counter() - t
+			t = time.perf_counter()
+			[decode(o) for o in x[key]]
+			models = time.perf_counter() - t
+			results += [
+				result('list.{0}.fetch'.format(name), 'ms', fetch * 1e3, items=n),
+				result('list.{0}.decode'.format(name), 'ms', models * 1e3, items=n),
+				result('list.{0}.decode_per_item'.format(name), 'us', models / n * 1e6),
+			]
+		server.outputs.clear()
+		client.delete_collection(collection.id)
+	return results
+
+def bench_message_construction(server, args):
+	"""OutputDataMessage construction rate, with and without decoding, and
+	with the device interned through a DeviceRegistry."""
+	n = args.messages
+	x = {
+		'device': {'deviceId': '1', 'collectionId': '2', 'imsi': '3', 'imei': '4', 'tags': {'a': 'b'}},
+		'payload': base64.b64encode(b'\0' * 32).decode('ascii'),
+		'received': 1546300800000,
+	}
+	t = time.perf_counter()
+	for _ in range(n):
+		nbiot.OutputDataMessage(x)
+	lazy = time.perf_counter() - t
+	t = time.perf_counter()
+	for _ in range(n):
+		m = nbiot.OutputDataMessage(x)
+		m.device, m.payload, m.received
+	full = time.perf_counter() - t
+	t = time.perf_counter()
+	for _ in range(n):
+		nbiot.OutputDataMessage(x).device
+	device = time.perf_counter() - t
+	registry = nbiot.DeviceRegistry('2')
+	t = time.perf_counter()
+	for _ in range(n):
+		nbiot._data_message(x, registry).device
+	interned = time.perf_counter() - t
+	return [
+		result('message.construct', 'msg/s', n / lazy),
+		result('message.construct_decode', 'msg/s', n / full),
+		result('message.construct_device', 'msg/s', n / device),
+		result('message.construct_device_registry', 'msg/s', n / interned),
+	]
+
+def bench_decode(server, args):
+	"""Payload decoding rate, one message at a time and a batch at once."""
+	n = args.messages
+	layout = struct.Struct('<hHIq')
+	device = nbiot.Device(id='1', collection_id='2')
+	batch = nbiot.OutputDataBatch(
+		nbiot.OutputDataMessage(device=device, payload=layout.pack(i % 100, i % 1000, i, i), received=nbiot.EPOCH)
+		for i in range(n)
+	)
+	decoder = decoders.StructDecoder(layout.format, ('temperature', 'humidity', 'counter', 'timestamp'))
+	t = time.perf_counter()
+	for m in batch:
+		decoder.decode(m.payload)
+	single = time.perf_counter() - t
+	t = time.perf_counter()
+	decoder.decode_batch(batch)
+	batched = time.perf_counter() - t
+	return [
+		result('decode.message', 'msg/s', n / single),
+		result('decode.batch', 'msg/s', n / batched),
+	]
+
+def bench_stream(server, args):
+	"""End-to-end OutputStream throughput at several payload sizes, one message
+	per recv and batched with recv_many."""
+	n = args.stream_messages
+	with nbiot.Client(addr=server.addr, token=server.token) as client:
+		collection = client.create_collection(nbiot.Collection())
+		device = client.create_device(collection.id, nbiot.Device(imsi='stream', imei='stream'))
+
+		async def run(size, batched):
+			stream = await client.collection_output_stream(collection.id)
+			t = time.perf_counter()
+			done = server.generate(collection.id, rate=float('inf'), count=n, payload=b'\0' * size, device_ids=[device.id])
+			received = 0
+			while received < n:
+				if batched:
+					received += len(await stream.recv_many(n - received))
+				else:
+					await stream.recv()
+					received += 1
+			elapsed = time.perf_counter() - t
+			done.result()
+			await stream.close()
+			return elapsed
+
+		results = []
+		for size in args.payload_sizes:
+			elapsed = asyncio.run(run(size, False))
+			results.append(result('stream.recv', 'msg/s', n / elapsed, payload_size=size))
+			elapsed = asyncio.run(run(size, True))
+			results.append(result('stream.recv_many', 'msg/s', n / elapsed, payload_size=size))
+		client.delete_collection(collection.id)
+	return results
+
+BENCHMARKS = [bench_import, bench_request, bench_list_decoding, bench_message_construction, bench_decode, bench_stream]
+
+def result(name, unit, value, **params):
+	return dict(name=name, unit=unit, value=round(value, 3), **params)
+
+def median(xs):
+	xs = sorted(xs)
+	return xs[len(xs) // 2]
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--quick', action='store_true', help='use small sizes, for smoke testing')
+	parser.add_argument('--output', help='write the results to this file instead of stdout')
+	parser.add_argument('--only', action='append', help='run only the named benchmarks')
+	args = parser.parse_args()
+	args.requests = 20 if args.quick else 200
+	args.items = 1000 if args.quick else 10000
+	args.messages = 10000 if args.quick else 200000
+	args.stream_messages = 1000 if args.quick else 20000
+	args.payload_sizes = [16, 256, 4096]
+
+	results = []
+	with FakeServer() as server:
+		for bench in BENCHMARKS:
+			if args.only and bench.__name__ not in args.only:
+				continue
+			results += bench(server, args)
+
+	report = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'time': int(time.time()),
+		'results': results,
+	}
+	out = open(args.output, 'w') if args.output else sys.stdout
+	json.dump(report, out, indent=1)
+	out.write('\n')
+
+if __name__ == '__main__':
+	main()
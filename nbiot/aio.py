@@ -0,0 +1,302 @@
+import asyncio
+import time
+
+import aiohttp
+
+from .nbiot import (
+	CONFIG_FILE,
+	DEFAULT_PAGE_SIZE,
+	DEFAULT_POOL_SIZE,
+	DEFAULT_RETRIES,
+	DEFAULT_TIMEOUT,
+	RETRY_BACKOFF_FACTOR,
+	RETRY_METHODS,
+	RETRY_STATUS_CODES,
+	BroadcastResult,
+	ClientError,
+	Collection,
+	Device,
+	DeviceRegistry,
+	Invite,
+	Member,
+	OutputLogEntry,
+	OutputStatus,
+	RequestEvent,
+	SystemDefaults,
+	Team,
+	_DataPager,
+	_data_message,
+	_data_path,
+	_output,
+	_output_stream,
+	_path_template,
+	_registered,
+	_resilient_output_stream,
+	_retry_after,
+	_timestamp,
+	addressTokenFromConfig,
+	default_codec,
+)
+
+class AsyncClient:
+	"""Construct a new asyncio client.  The arguments and the default configuration
+	are those of nbiot.Client except cache and lazy, and the methods return the
+	same model classes, but every request is a coroutine that runs on a
+	non-blocking connection pool shared by all tasks using the client.  The
+	concurrent bulk methods (backfill, send_many and the *_devices methods) are
+	left out; gather the single-item coroutines instead.
+
+	The pool is created on the first request, so the client can be constructed
+	outside of a running event loop.  Unlike nbiot.Client the constructor does
+	not ping the server; await ping() to check the connection."""
+	def __init__(self, addr=None, token=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, instrumentation=None, codec=None, rate_limiter=None):
+		if addr is None or token is None:
+			addr, token = addressTokenFromConfig(CONFIG_FILE)
+		self.addr = addr
+		self.token = token
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.retries = retries
+		self.instrumentation = instrumentation
+		self.codec = codec or default_codec()
+		self.rate_limiter = rate_limiter
+		self._registries = {}
+		self._session = None
+
+	async def close(self):
+		if self._session is not None:
+			await self._session.close()
+			self._session = None
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def ping(self):
+		try:
+			await self._request('GET', '/')
+		except ClientError as err:
+			# A token with restricted access will receive 403 Forbidden from "/"
+			# but that still indicates a succesful connection.
+			if err.http_status_code != 403:
+				raise err
+
+	async def system_defaults(self):
+		x = await self._request('GET', '/system')
+		return SystemDefaults(x)
+
+	async def teams(self):
+		x = await self._request('GET', '/teams')
+		return [Team(json=t) for t in x['teams']]
+	async def team(self, id):
+		x = await self._request('GET', '/teams/'+id)
+		return Team(json=x)
+	async def create_team(self, team):
+		x = await self._request('POST', '/teams', team)
+		return Team(json=x)
+	async def update_team(self, team):
+		x = await self._request('PATCH', '/teams/'+team.id, team)
+		return Team(json=x)
+	async def update_team_member_role(self, team_id, user_id, role):
+		x = await self._request('PATCH', '/teams/{0}/members/{1}'.format(team_id, user_id), Member(role=role))
+		return Member(json=x)
+	async def delete_team_member(self, team_id, user_id):
+		await self._request('DELETE', '/teams/{0}/members/{1}'.format(team_id, user_id))
+	async def delete_team_tag(self, id, name):
+		await self._request('DELETE', '/teams/{0}/tags/{1}'.format(id, name))
+	async def delete_team(self, id):
+		await self._request('DELETE', '/teams/'+id)
+
+
+	async def invites(self, team_id):
+		x = await self._request('GET', '/teams/{0}/invites'.format(team_id))
+		return [Invite(json=i) for i in x['invites']]
+	async def invite(self, team_id, code):
+		x = await self._request('GET', '/teams/{0}/invites/{1}'.format(team_id, code))
+		return Invite(json=x)
+	async def create_invite(self, team_id):
+		x = await self._request('POST', '/teams/{0}/invites'.format(team_id))
+		return Invite(json=x)
+	async def accept_invite(self, code):
+		x = await self._request('POST', '/teams/accept', Invite(code=code))
+		return Team(json=x)
+	async def delete_invite(self, team_id, code):
+		await self._request('DELETE', '/teams/{0}/invites/{1}'.format(team_id, code))
+
+
+	async def collections(self):
+		x = await self._request('GET', '/collections')
+		return [Collection(json=c) for c in x['collections']]
+	async def collection(self, id):
+		x = await self._request('GET', '/collections/'+id)
+		return Collection(json=x)
+	async def create_collection(self, collection):
+		x = await self._request('POST', '/collections', collection)
+		return Collection(json=x)
+	async def update_collection(self, collection):
+		x = await self._request('PATCH', '/collections/'+collection.id, collection)
+		return Collection(json=x)
+	async def delete_collection_tag(self, id, name):
+		await self._request('DELETE', '/collections/{0}/tags/{1}'.format(id, name))
+	async def delete_collection(self, id):
+		await self._request('DELETE', '/collections/'+id)
+		self._registries.pop(id, None)
+
+	async def devices(self, collection_id):
+		x = await self._request('GET', '/collections/{0}/devices'.format(collection_id))
+		return [Device(json=d) for d in x['devices']]
+	async def device(self, collection_id, device_id):
+		x = await self._request('GET', '/collections/{0}/devices/{1}'.format(collection_id, device_id))
+		return Device(json=x)
+	async def create_device(self, collection_id, device):
+		x = await self._request('POST', '/collections/{0}/devices'.format(collection_id), device)
+		return _registered(self._registries.get(collection_id), Device(json=x))
+	async def update_device(self, collection_id, device):
+		x = await self._request('PATCH', '/collections/{0}/devices/{1}'.format(collection_id, device.id), device)
+		return _registered(self._registries.get(collection_id), Device(json=x))
+	async def delete_device_tag(self, collection_id, device_id, name):
+		await self._request('DELETE', '/collections/{0}/devices/{1}/tags/{2}'.format(collection_id, device_id, name))
+		registry = self._registries.get(collection_id)
+		if registry is not None:
+			registry.remove_tag(device_id, name)
+	async def delete_device(self, collection_id, device_id):
+		await self._request('DELETE', '/collections/{0}/devices/{1}'.format(collection_id, device_id))
+		registry = self._registries.get(collection_id)
+		if registry is not None:
+			registry.remove(device_id)
+
+	async def device_registry(self, collection_id):
+		registry = self._registries.get(collection_id)
+		if registry is None:
+			registry = DeviceRegistry(collection_id, await self.devices(collection_id))
+			registry = self._registries.setdefault(collection_id, registry)
+		return registry
+
+	async def outputs(self, collection_id):
+		x = await self._request('GET', '/collections/{0}/outputs'.format(collection_id))
+		return [_output(o) for o in x['outputs']]
+	async def output(self, collection_id, output_id):
+		x = await self._request('GET', '/collections/{0}/outputs/{1}'.format(collection_id, output_id))
+		return _output(x)
+	async def create_output(self, collection_id, output):
+		x = await self._request('POST', '/collections/{0}/outputs'.format(collection_id), output)
+		return _output(x)
+	async def update_output(self, collection_id, output):
+		x = await self._request('PATCH', '/collections/{0}/outputs/{1}'.format(collection_id, output.id), output)
+		return _output(x)
+	async def output_logs(self, collection_id, output_id):
+		x = await self._request('GET', '/collections/{0}/outputs/{1}/logs'.format(collection_id, output_id))
+		return [OutputLogEntry(l) for l in x['logs']]
+	async def output_status(self, collection_id, output_id):
+		x = await self._request('GET', '/collections/{0}/outputs/{1}/status'.format(collection_id, output_id))
+		return OutputStatus(x)
+	async def delete_output_tag(self, collection_id, output_id, name):
+		await self._request('DELETE', '/collections/{0}/outputs/{1}/tags/{2}'.format(collection_id, output_id, name))
+	async def delete_output(self, collection_id, output_id):
+		await self._request('DELETE', '/collections/{0}/outputs/{1}'.format(collection_id, output_id))
+
+	async def collection_data(self, collection_id, since=None, until=None, limit=0):
+		return await self._data('/collections/{0}'.format(collection_id), since, until, limit, self._registries.get(collection_id))
+	async def device_data(self, collection_id, device_id, since=None, until=None, limit=0):
+		return await self._data('/collections/{0}/devices/{1}'.format(collection_id, device_id), since, until, limit, self._registries.get(collection_id))
+	async def _data(self, path, since=None, until=None, limit=0, registry=None):
+		x = await self._request('GET', _data_path(path, _timestamp(since), _timestamp(until), limit))
+		return [_data_message(m, registry) for m in x['messages']]
+
+	def iter_collection_data(self, collection_id, since=None, until=None, page_size=DEFAULT_PAGE_SIZE):
+		return self._iter_data('/collections/{0}'.format(collection_id), _timestamp(since), _timestamp(until), page_size, self._registries.get(collection_id))
+	def iter_device_data(self, collection_id, device_id, since=None, until=None, page_size=DEFAULT_PAGE_SIZE):
+		return self._iter_data('/collections/{0}/devices/{1}'.format(collection_id, device_id), _timestamp(since), _timestamp(until), page_size, self._registries.get(collection_id))
+	async def _iter_data(self, path, since, until, page_size, registry=None):
+		pager = _DataPager(path, since, until, page_size)
+		while not pager.done:
+			x = await self._request('GET', pager.path())
+			for m in pager.next(x['messages']):
+				yield _data_message(m, registry)
+
+	async def send(self, collection_id, device_id, msg):
+		await self._request('POST', '/collections/{0}/devices/{1}/to'.format(collection_id, device_id), msg)
+	async def broadcast(self, collection_id, msg):
+		x = await self._request('POST', '/collections/{0}/to'.format(collection_id), msg)
+		return BroadcastResult(x)
+
+	async def _request(self, method, path, x=None):
+		inst = self.instrumentation
+		if inst is None:
+			return await self._send(method, path, x, None)
+		event = RequestEvent(method, _path_template(path))
+		start = time.perf_counter()
+		try:
+			return await self._send(method, path, x, event)
+		except Exception as err:
+			event.error = type(err).__name__
+			raise
+		finally:
+			event.latency = time.perf_counter() - start
+			inst.on_request(event)
+
+	async def _send(self, method, path, x, event):
+		body = x and self.codec.dumps(x.json())
+		session = self._client_session()
+		limiter = self.rate_limiter
+		route = limiter and _path_template(path)
+		attempts = self.retries + 1 if method in RETRY_METHODS else 1
+		throttled = False
+		for attempt in range(attempts):
+			if attempt > 0 and not throttled:
+				await asyncio.sleep(RETRY_BACKOFF_FACTOR * (2 ** (attempt - 1)))
+			throttled = False
+			if limiter is not None:
+				await asyncio.sleep(limiter.reserve(method, route))
+			try:
+				async with session.request(method, self.addr + path, data=body) as resp:
+					if limiter is not None:
+						if resp.status == 429:
+							limiter.throttled(method, route, _retry_after(resp.headers.get('Retry-After')))
+							# The limiter now spaces out the retry.
+							throttled = True
+							if attempt + 1 < attempts:
+								continue
+						else:
+							limiter.succeeded(method, route)
+					if resp.status in RETRY_STATUS_CODES and attempt + 1 < attempts:
+						continue
+					content = await resp.read()
+					if event is not None:
+						event.status = resp.status
+						event.size = len(content)
+						event.retries = attempt
+					if resp.status >= 400:
+						raise ClientError(http_status_code=resp.status, message=content.decode('utf-8', 'replace'), retry_after=_retry_after(resp.headers.get('Retry-After')))
+					if method != 'DELETE' and content:
+						return self.codec.loads(content)
+					return None
+			except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+				if attempt + 1 == attempts:
+					raise
+
+	def _client_session(self):
+		if self._session is None:
+			connect, read = self.timeout
+			self._session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=self.pool_size),
+				timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+				headers={'X-API-Token': self.token, 'Content-Type': 'application/json'},
+			)
+		return self._session
+
+	def collection_output_stream(self, id, resilient=False, on_frame=None):
+		return self._output_stream('/collections/'+id, resilient, on_frame, self._registries.get(id))
+	def device_output_stream(self, collection_id, device_id, resilient=False, on_frame=None):
+		return self._output_stream('/collections/{0}/devices/{1}'.format(collection_id, device_id), resilient, on_frame, self._registries.get(collection_id))
+
+	def _output_stream(self, path, resilient=False, on_frame=None, registry=None):
+		if not resilient:
+			return _output_stream(self.addr, self.token, path, self.instrumentation, self.codec, on_frame, registry)
+		async def history(since):
+			return [m async for m in self._iter_data(path, since, 0, DEFAULT_PAGE_SIZE, registry)]
+		errors = (ClientError, aiohttp.ClientError, asyncio.TimeoutError)
+		connect = lambda: _output_stream(self.addr, self.token, path, self.instrumentation, self.codec, on_frame, registry)
+		return _resilient_output_stream(connect, history, errors)
@@ -0,0 +1,158 @@
+import asyncio
+import pytest
+
+from nbiot import nbiot
+
+pytest.importorskip('aiohttp')
+from nbiot.aio import AsyncClient
+
+from nbiot.nbiot_test import randid
+
+@pytest.mark.asyncio
+async def test_crud():
+	async with AsyncClient() as client:
+		await client.ping()
+		await client.system_defaults()
+
+		team = await client.create_team(nbiot.Team())
+		try:
+			team.tags['key'] = 'value'
+			team = await client.update_team(team)
+			assert (await client.team(team.id)).tags == {'key': 'value'}
+			assert team.id in [t.id for t in await client.teams()]
+		finally:
+			await client.delete_team(team.id)
+
+		collection = await client.create_collection(nbiot.Collection())
+		try:
+			collection.tags['key'] = 'value'
+			collection = await client.update_collection(collection)
+			assert (await client.collection(collection.id)).tags == {'key': 'value'}
+
+			device = await client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid()))
+			device.tags['key'] = 'value'
+			device = await client.update_device(collection.id, device)
+			assert (await client.device(collection.id, device.id)).tags == {'key': 'value'}
+			assert [d.id for d in await client.devices(collection.id)] == [device.id]
+
+			registry = await client.device_registry(collection.id)
+			assert registry.get(device.id).tags == {'key': 'value'}
+			await client.delete_device_tag(collection.id, device.id, 'key')
+			assert registry.get(device.id).tags == {}
+			await client.delete_device(collection.id, device.id)
+			assert registry.get(device.id) is None
+			assert await client.devices(collection.id) == []
+
+			output = await client.create_output(collection.id, nbiot.WebHookOutput(url=nbiot.DEFAULT_ADDRESS))
+			assert [o.id for o in await client.outputs(collection.id)] == [output.id]
+			await client.update_output(collection.id, output)
+			assert await client.output_logs(collection.id, output.id) == []
+			await client.output_status(collection.id, output.id)
+			await client.delete_output(collection.id, output.id)
+			assert await client.outputs(collection.id) == []
+		finally:
+			await client.delete_collection(collection.id)
+		assert collection.id not in [c.id for c in await client.collections()]
+
+@pytest.mark.asyncio
+async def test_errors():
+	async with AsyncClient() as client:
+		with pytest.raises(nbiot.ClientError) as err:
+			await client.collection('0')
+		assert err.value.http_status_code == 404
+		addr = client.addr
+
+	async with AsyncClient(addr, token='invalid') as client:
+		with pytest.raises(nbiot.ClientError) as err:
+			await client.collections()
+		assert err.value.http_status_code in (401, 403)
+
+@pytest.mark.asyncio
+async def test_data(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	async with AsyncClient() as client:
+		collection = await client.create_collection(nbiot.Collection())
+		try:
+			devices = [await client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid())) for i in range(3)]
+			start = 1546300800000
+			for i in range(30):
+				server.inject(collection.id, devices[i % 3].id, bytes([i]), received=start + i // 2)
+
+			assert len(await client.collection_data(collection.id, limit=5)) == 5
+			assert len(await client.device_data(collection.id, devices[0].id)) == 10
+			msgs = [m async for m in client.iter_collection_data(collection.id, page_size=7)]
+			assert [m.payload for m in msgs] == [bytes([i]) for i in reversed(range(30))]
+			msgs = [m async for m in client.iter_device_data(collection.id, devices[0].id, page_size=4)]
+			assert len(msgs) == 10
+		finally:
+			await client.delete_collection(collection.id)
+
+@pytest.mark.asyncio
+async def test_retries(server):
+	if server is None:
+		pytest.skip('needs the fake server to fail requests')
+	async with AsyncClient() as client:
+		# GET is retried on 5xx; POST is not, since it may have taken effect.
+		requests = server.requests
+		server.fail(2)
+		await client.collections()
+		assert server.requests - requests == 3
+
+		server.fail(1)
+		with pytest.raises(nbiot.ClientError) as err:
+			await client.create_collection(nbiot.Collection())
+		assert err.value.http_status_code == 503
+
+	async with AsyncClient(retries=1) as client:
+		server.fail(2, status=502)
+		with pytest.raises(nbiot.ClientError) as err:
+			await client.collections()
+		assert err.value.http_status_code == 502
+
+@pytest.mark.asyncio
+async def test_throttling(server):
+	if server is None:
+		pytest.skip('needs the fake server to throttle requests')
+	async with AsyncClient() as client:
+		server.throttle(1, retry_after=2)
+		with pytest.raises(nbiot.ClientError) as err:
+			await client.collections()
+		assert err.value.http_status_code == 429
+		assert err.value.retry_after == 2
+
+	limiter = nbiot.RateLimiter(rate=100)
+	async with AsyncClient(rate_limiter=limiter) as client:
+		server.throttle(1, retry_after=1)
+		start = nbiot.time.monotonic()
+		await client.collections()
+		assert nbiot.time.monotonic() - start >= 1
+		assert limiter.rate('GET', '/collections') < 100
+
+@pytest.mark.asyncio
+async def test_output_stream(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	async with AsyncClient() as client:
+		collection = await client.create_collection(nbiot.Collection())
+		try:
+			device = await client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid()))
+			registry = await client.device_registry(collection.id)
+			stream = await client.device_output_stream(collection.id, device.id)
+			server.inject(collection.id, device.id, b'one')
+			msg = await asyncio.wait_for(stream.recv(), 1)
+			assert msg.payload == b'one'
+			assert msg.device is registry.get(device.id)
+			await stream.close()
+
+			stream = await client.collection_output_stream(collection.id, resilient=True)
+			server.inject(collection.id, device.id, b'two', received=2)
+			assert (await asyncio.wait_for(stream.recv(), 1)).payload == b'two'
+			# The message sent while the stream is down is recovered from history.
+			server.drop_streams()
+			server.inject(collection.id, device.id, b'three', received=3)
+			assert (await asyncio.wait_for(stream.recv(), 5)).payload == b'three'
+			assert stream.reconnects == 1
+			await stream.close()
+		finally:
+			await client.delete_collection(collection.id)
@@ -0,0 +1,253 @@
+import argparse
+import base64
+import csv
+from datetime import datetime, timezone
+import os
+import sys
+import time
+
+from . import nbiot
+from .nbiot import DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, DEFAULT_WORKERS, OutputStreamClosed
+
+# Progress is reported on stderr at most this often, in seconds.
+PROGRESS_INTERVAL = 1.0
+# Devices are created in chunks of this many per worker between reports.
+IMPORT_CHUNK = 16
+
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl', '.json')
+
+def main(argv=None):
+	"""The entry point of the nbiot command.  Returns the exit status."""
+	args = _parser().parse_args(argv)
+	addr, token = nbiot.addressTokenFromConfig(nbiot.CONFIG_FILE)
+	client = nbiot.Client(
+		args.address or addr,
+		args.token or token,
+		pool_size=max(nbiot.DEFAULT_POOL_SIZE, getattr(args, 'workers', 0)),
+		lazy=True,
+	)
+	progress = Progress(sys.stderr, quiet=args.quiet)
+	try:
+		with client:
+			return args.command(client, args, progress)
+	except nbiot.ClientError as err:
+		print('nbiot: {0}'.format(err.message), file=sys.stderr)
+		return 1
+	except KeyboardInterrupt:
+		return 130
+	except BrokenPipeError:
+		# The reader went away, as with "nbiot tail ... | head".  Point stdout
+		# at /dev/null so flushing it at exit does not fail again.
+		os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+		return 0
+	finally:
+		progress.done()
+
+def _parser():
+	parser = argparse.ArgumentParser(prog='nbiot', description='Command-line client for the Telenor NB-IoT API.')
+	parser.add_argument('--address', help='API address; default from ~/{0} or {1}'.format(nbiot.CONFIG_FILE, nbiot.ADDRESS_ENV_VAR))
+	parser.add_argument('--token', help='API token; default from ~/{0} or {1}'.format(nbiot.CONFIG_FILE, nbiot.TOKEN_ENV_VAR))
+	parser.add_argument('-q', '--quiet', action='store_true', help='do not report progress on stderr')
+	commands = parser.add_subparsers(metavar='command')
+	commands.required = True
+
+	p = commands.add_parser('tail', help='stream messages as NDJSON to stdout')
+	p.add_argument('collection')
+	p.add_argument('device', nargs='?')
+	p.add_argument('-n', '--count', type=int, help='stop after this many messages')
+	p.add_argument('--resilient', action='store_true', help='reconnect and replay missed messages when the stream drops')
+	p.set_defaults(command=tail)
+
+	p = commands.add_parser('export', help='write message history to a file')
+	p.add_argument('collection')
+	p.add_argument('output', help='output file, or - for NDJSON on stdout')
+	p.add_argument('--device')
+	p.add_argument('--since', type=_time, help='ISO 8601 time, UTC unless an offset is given')
+	p.add_argument('--until', type=_time, help='ISO 8601 time, UTC unless an offset is given')
+	p.add_argument('--format', choices=['ndjson', 'parquet', 'arrow', 'npz'], help='default from the file extension')
+	p.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+	p.set_defaults(command=export)
+
+	p = commands.add_parser('devices', help='bulk device provisioning')
+	devices = p.add_subparsers(metavar='command')
+	devices.required = True
+	p = devices.add_parser('import', help='create the devices listed in a CSV file')
+	p.add_argument('collection')
+	p.add_argument('file', help='CSV file with imsi and imei columns, or - for stdin; other columns become tags')
+	p.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+	p.set_defaults(command=import_devices)
+	p = devices.add_parser('export', help='write the devices of a collection as CSV')
+	p.add_argument('collection')
+	p.add_argument('file', nargs='?', default='-', help='CSV file, or - for stdout')
+	p.set_defaults(command=export_devices)
+	return parser
+
+def _time(s):
+	t = datetime.fromisoformat(s)
+	if t.tzinfo is None:
+		t = t.replace(tzinfo=timezone.utc)
+	return t
+
+
+def tail(client, args, progress):
+	"""Write the messages of an output stream to stdout, one JSON object per
+	line in the form the data API returns them.  Each batch of messages read
+	from the stream is written and flushed with one call."""
+	from .streams import StreamReader
+
+	out = sys.stdout.buffer
+	dumps = client.codec.dumps
+	left = args.count
+	with StreamReader(client, args.collection, args.device, args.resilient) as reader:
+		while left is None or left > 0:
+			try:
+				msgs = reader.recv_many(DEFAULT_BATCH_SIZE if left is None else min(left, DEFAULT_BATCH_SIZE), PROGRESS_INTERVAL)
+			except OutputStreamClosed:
+				break
+			if msgs:
+				out.write(b''.join([dumps(_record(m)) + b'\n' for m in msgs]))
+				out.flush()
+				if left is not None:
+					left -= len(msgs)
+			progress.add('tail', len(msgs))
+	return 0
+
+def _record(msg):
+	j = msg._json
+	if j is None:
+		return {
+			'device': msg.device.json(),
+			'payload': base64.b64encode(msg.payload).decode('ascii'),
+			'received': msg.received_ms,
+		}
+	return {'device': j['device'], 'payload': j['payload'], 'received': j['received']}
+
+def export(client, args, progress):
+	"""Write the history of a collection or device to NDJSON or, through
+	nbiot.export, to a columnar file."""
+	if args.device is None:
+		path = '/collections/{0}'.format(args.collection)
+	else:
+		path = '/collections/{0}/devices/{1}'.format(args.collection, args.device)
+	history = client._iter_data_json(path, nbiot._timestamp(args.since), nbiot._timestamp(args.until), args.page_size)
+
+	format = args.format
+	if format is None and (args.output == '-' or args.output.endswith(NDJSON_EXTENSIONS)):
+		format = 'ndjson'
+	if format != 'ndjson':
+		from .export import export as write
+		write(_counted(progress, (nbiot.OutputDataMessage(m) for m in history)), args.output, format)
+		return 0
+
+	out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+	try:
+		dumps = client.codec.dumps
+		lines = []
+		for m in history:
+			lines.append(dumps(m) + b'\n')
+			if len(lines) == args.page_size:
+				out.write(b''.join(lines))
+				progress.add('export', len(lines))
+				lines = []
+		out.write(b''.join(lines))
+		progress.add('export', len(lines))
+	finally:
+		if out is sys.stdout.buffer:
+			out.flush()
+		else:
+			out.close()
+	return 0
+
+def _counted(progress, messages):
+	for msg in messages:
+		yield msg
+		progress.add('export', 1)
+
+
+def import_devices(client, args, progress):
+	"""Create a device for every row of a CSV file, args.workers at a time.
+	The imsi and imei columns are required; a deviceId column is ignored so
+	that the output of devices export can be imported into another
+	collection, and every other non-empty column becomes a tag."""
+	f = sys.stdin if args.file == '-' else open(args.file, newline='')
+	try:
+		rows = list(csv.DictReader(f))
+	finally:
+		if f is not sys.stdin:
+			f.close()
+	devices = [_device(row) for row in rows]
+	# The first row is on line 2 of the file, after the header.
+	lines = {id(d): i + 2 for i, d in enumerate(devices)}
+
+	failed = 0
+	chunk = args.workers * IMPORT_CHUNK
+	for start in range(0, len(devices), chunk):
+		result = client.create_devices(args.collection, devices[start:start+chunk], args.workers)
+		for e in result.errors:
+			print('nbiot: line {0}: {1}'.format(lines[id(e.item)], getattr(e.error, 'message', e.error)), file=sys.stderr)
+		failed += len(result.failed)
+		progress.add('devices', len(result.succeeded))
+	return 1 if failed else 0
+
+def _device(row):
+	row = dict(row)
+	imsi, imei = row.pop('imsi', None), row.pop('imei', None)
+	if not imsi or not imei:
+		raise SystemExit('nbiot: every row needs an imsi and an imei')
+	row.pop('deviceId', None)
+	return nbiot.Device(imsi=imsi, imei=imei, tags={k: v for k, v in row.items() if k and v})
+
+def export_devices(client, args, progress):
+	"""Write the devices of a collection as CSV with a column per tag name."""
+	devices = client.devices(args.collection)
+	tags = sorted({name for d in devices for name in d.tags})
+	f = sys.stdout if args.file == '-' else open(args.file, 'w', newline='')
+	try:
+		w = csv.writer(f)
+		w.writerow(['deviceId', 'imsi', 'imei'] + tags)
+		for d in devices:
+			w.writerow([d.id, d.imsi, d.imei] + [d.tags.get(name, '') for name in tags])
+	finally:
+		if f is not sys.stdout:
+			f.close()
+	progress.add('devices', len(devices))
+	return 0
+
+
+class Progress:
+	"""Report a running count and rate per second on a terminal stream,
+	rewriting one line at most every PROGRESS_INTERVAL seconds."""
+	def __init__(self, stream, interval=PROGRESS_INTERVAL, quiet=False):
+		self.stream = stream
+		self.interval = interval
+		self.quiet = quiet
+		self.label = None
+		self.count = 0
+		self.start = None
+		self._shown = 0
+
+	def add(self, label, n):
+		now = time.monotonic()
+		if self.start is None:
+			self.start = self._shown = now
+		self.label = label
+		self.count += n
+		if now - self._shown >= self.interval:
+			self._shown = now
+			self._show(now, '\r')
+
+	def done(self):
+		if self.start is not None:
+			self._show(time.monotonic(), '\r', '\n')
+			self.start = None
+
+	def _show(self, now, start, end=''):
+		if self.quiet:
+			return
+		elapsed = now - self.start
+		rate = self.count / elapsed if elapsed > 0 else 0
+		self.stream.write('{0}{1}: {2} in {3:.1f}s, {4:.0f}/s{5}'.format(start, self.label, self.count, elapsed, rate, end))
+		self.stream.flush()
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,54 @@
+import base64
+import csv
+import json
+import threading
+import time
+import pytest
+
+from nbiot import nbiot
+from nbiot import cli
+
+@pytest.fixture
+def collection():
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	yield collection.id
+	client.delete_collection(collection.id)
+
+def test_devices(collection, tmp_path, capsys):
+	path = tmp_path / 'devices.csv'
+	path.write_text('imsi,imei,name\ncli1,cli1,a\ncli2,cli2,\ncli1,cli3,c\n')
+	assert cli.main(['devices', 'import', collection, str(path), '--workers', '2']) == 1
+	assert 'line 4:' in capsys.readouterr().err
+
+	assert cli.main(['-q', 'devices', 'export', collection]) == 0
+	rows = sorted(csv.DictReader(capsys.readouterr().out.splitlines()), key=lambda r: r['imsi'])
+	assert [(r['imsi'], r['imei'], r['name']) for r in rows] == [('cli1', 'cli1', 'a'), ('cli2', 'cli2', '')]
+
+def test_tail_export(server, collection, tmp_path, capsysbinary):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	device = nbiot.Client().create_device(collection, nbiot.Device(imsi='tail', imei='tail'))
+	status = []
+	tail = threading.Thread(target=lambda: status.append(cli.main(['tail', collection, '-n', '50'])))
+	tail.start()
+	deadline = time.monotonic() + 5
+	while not server._subscribers and time.monotonic() < deadline:
+		time.sleep(0.01)
+	server.generate(collection, rate=float('inf'), count=50, payload=b'tail', device_ids=[device.id]).result()
+	tail.join(5)
+	assert status == [0]
+	out, err = capsysbinary.readouterr()
+	lines = [json.loads(line) for line in out.splitlines()]
+	assert len(lines) == 50
+	assert all(base64.b64decode(m['payload']) == b'tail' and m['device']['deviceId'] == device.id for m in lines)
+	assert b'tail: 50' in err
+
+	assert cli.main(['-q', 'export', collection, '-', '--device', device.id]) == 0
+	history = [json.loads(line) for line in capsysbinary.readouterr().out.splitlines()]
+	assert sorted(history, key=lambda m: m['received']) == sorted(lines, key=lambda m: m['received'])
+
+	path = tmp_path / 'data.npz'
+	assert cli.main(['-q', 'export', collection, str(path), '--since', '2000-01-01T00:00:00']) == 0
+	from nbiot import export
+	assert sum(len(c) for c in export.read_npz(path)) == 50
@@ -0,0 +1,21 @@
+import os
+import pytest
+
+from nbiot import nbiot
+from nbiot.fakeserver import FakeServer
+
+@pytest.fixture(scope='session', autouse=True)
+def server():
+	"""Run the tests against an in-process FakeServer unless a token for the
+	real API is given in TELENOR_NBIOT_TOKEN."""
+	if os.environ.get(nbiot.TOKEN_ENV_VAR):
+		yield None
+		return
+	with FakeServer() as server:
+		os.environ[nbiot.ADDRESS_ENV_VAR] = server.addr
+		os.environ[nbiot.TOKEN_ENV_VAR] = server.token
+		try:
+			yield server
+		finally:
+			del os.environ[nbiot.ADDRESS_ENV_VAR]
+			del os.environ[nbiot.TOKEN_ENV_VAR]
@@ -0,0 +1,144 @@
+from array import array
+import struct
+
+from .nbiot import OutputDataBatch
+
+class StructDecoder:
+	"""Decode fixed-layout binary payloads described by a struct format into
+	records with the given field names.  decode_batch unpacks all the payloads
+	of an OutputDataBatch in one pass over its payload buffer."""
+	def __init__(self, format, names):
+		self.struct = struct.Struct(format)
+		self.names = tuple(names)
+		self.size = self.struct.size
+		fields = len(self.struct.unpack(bytes(self.size)))
+		if fields != len(self.names):
+			raise ValueError('{0!r} has {1} fields but {2} names were given'.format(format, fields, len(self.names)))
+
+	def decode(self, payload):
+		"""Return a dict of the fields of one payload.  Payloads may be longer
+		than the layout; trailing bytes are ignored."""
+		return dict(zip(self.names, self.struct.unpack_from(payload)))
+
+	def decode_batch(self, batch):
+		"""Return a dict mapping each field name to a list of its values, one per
+		message in the batch."""
+		if _uniform(batch, self.size):
+			rows = self.struct.iter_unpack(batch.payloads)
+		else:
+			unpack = self.struct.unpack_from
+			rows = [unpack(batch.payload(i)) for i in range(len(batch))]
+		columns = list(zip(*rows)) or [()] * len(self.names)
+		return {name: list(column) for name, column in zip(self.names, columns)}
+
+class NumpyDecoder:
+	"""Decode fixed-layout binary payloads described by a NumPy dtype.
+	decode_batch returns a structured array viewing the payload buffer of an
+	OutputDataBatch without copying when every payload has the dtype's size;
+	copy it before clearing or extending the batch."""
+	def __init__(self, dtype):
+		import numpy
+		self._numpy = numpy
+		self.dtype = numpy.dtype(dtype)
+		self.size = self.dtype.itemsize
+
+	def decode(self, payload):
+		return self._numpy.frombuffer(payload, self.dtype, count=1)[0]
+
+	def decode_batch(self, batch):
+		np = self._numpy
+		if _uniform(batch, self.size):
+			return np.frombuffer(batch.payloads, self.dtype)
+		out = np.empty(len(batch), self.dtype)
+		for i in range(len(batch)):
+			out[i] = np.frombuffer(batch.payload(i), self.dtype, count=1)[0]
+		return out
+
+class FunctionDecoder:
+	"""Decode payloads one at a time with a function of the payload bytes."""
+	def __init__(self, fn):
+		self.fn = fn
+
+	def decode(self, payload):
+		return self.fn(payload)
+
+	def decode_batch(self, batch):
+		fn = self.fn
+		return [fn(bytes(batch.payload(i))) for i in range(len(batch))]
+
+def _uniform(batch, size):
+	"""Whether every payload in the batch is exactly size bytes long."""
+	n = len(batch)
+	if len(batch.payloads) != n * size:
+		return False
+	return batch.offsets == array('q', range(0, (n + 1) * size, size))
+
+
+class DecoderRegistry:
+	"""Choose a decoder for each message by the tags of its device or by its
+	collection.  Decoders registered for a tag value take precedence over those
+	for a collection, which take precedence over the default; among tags the
+	first registered tag name wins.
+
+	Plain functions of the payload bytes can be registered too; they are
+	wrapped in a FunctionDecoder."""
+	def __init__(self, default=None):
+		self.default = default and _decoder(default)
+		self._tags = {}
+		self._collections = {}
+
+	def register(self, decoder, collection_id=None, tag=None):
+		"""Register decoder for the devices of a collection, or for the devices
+		whose tag name has the given value when tag is a (name, value) pair."""
+		decoder = _decoder(decoder)
+		if tag is not None:
+			name, value = tag
+			self._tags.setdefault(name, {})[value] = decoder
+		elif collection_id is not None:
+			self._collections[collection_id] = decoder
+		else:
+			self.default = decoder
+		return decoder
+
+	def decoder(self, device):
+		"""Return the decoder for a device, or None."""
+		tags = device.tags
+		if tags:
+			for name, decoders in self._tags.items():
+				decoder = decoders.get(tags.get(name))
+				if decoder is not None:
+					return decoder
+		return self._collections.get(device.collection_id, self.default)
+
+	def decode(self, msg):
+		"""Decode the payload of one message.  Raises LookupError if no decoder
+		applies."""
+		decoder = self.decoder(msg.device)
+		if decoder is None:
+			raise LookupError('no decoder for device {0}'.format(msg.device.id))
+		return decoder.decode(msg.payload)
+
+	def decode_batch(self, batch):
+		"""Split an OutputDataBatch by decoder and decode each part in one call.
+		Returns a list of (decoder, batch, decoded) triples; messages without a
+		decoder are left out.  When one decoder covers the whole batch, as is
+		usual for a single collection, the batch is decoded without copying."""
+		decoders = [self.decoder(d) for d in batch.devices]
+		if len(set(map(id, decoders))) == 1:
+			if decoders[0] is None:
+				return []
+			return [(decoders[0], batch, decoders[0].decode_batch(batch))]
+
+		parts = {}
+		for i, j in enumerate(batch.device_index):
+			decoder = decoders[j]
+			if decoder is None:
+				continue
+			part = parts.get(id(decoder))
+			if part is None:
+				part = parts[id(decoder)] = (decoder, OutputDataBatch())
+			part[1].append(batch[i])
+		return [(decoder, part, decoder.decode_batch(part)) for decoder, part in parts.values()]
+
+def _decoder(x):
+	return x if hasattr(x, 'decode_batch') else FunctionDecoder(x)
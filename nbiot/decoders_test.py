@@ -0,0 +1,72 @@
+import pytest
+import struct
+
+from nbiot import nbiot
+from nbiot import decoders
+
+LAYOUT = '<hHI'
+NAMES = ('temperature', 'humidity', 'counter')
+
+def message(device, payload):
+	return nbiot.OutputDataMessage(device=device, payload=payload, received=nbiot.EPOCH)
+
+def test_struct_decoder():
+	decoder = decoders.StructDecoder(LAYOUT, NAMES)
+	assert decoder.decode(struct.pack(LAYOUT, -5, 40, 7)) == {'temperature': -5, 'humidity': 40, 'counter': 7}
+
+	device = nbiot.Device(id='1')
+	batch = nbiot.OutputDataBatch(message(device, struct.pack(LAYOUT, i, i * 2, i * 3)) for i in range(10))
+	columns = decoder.decode_batch(batch)
+	assert columns['temperature'] == list(range(10))
+	assert columns['counter'] == [i * 3 for i in range(10)]
+
+	batch.append(message(device, struct.pack(LAYOUT, 10, 20, 30) + b'trailer'))
+	assert decoder.decode_batch(batch)['humidity'][-1] == 20
+	assert decoder.decode_batch(nbiot.OutputDataBatch()) == {name: [] for name in NAMES}
+
+	with pytest.raises(ValueError):
+		decoders.StructDecoder(LAYOUT, NAMES[:2])
+
+def test_numpy_decoder():
+	pytest.importorskip('numpy')
+	decoder = decoders.NumpyDecoder([('temperature', '<i2'), ('humidity', '<u2'), ('counter', '<u4')])
+	device = nbiot.Device(id='1')
+	batch = nbiot.OutputDataBatch(message(device, struct.pack(LAYOUT, i, i * 2, i * 3)) for i in range(10))
+	records = decoder.decode_batch(batch)
+	assert list(records['counter']) == [i * 3 for i in range(10)]
+	del records
+	batch.append(message(device, struct.pack(LAYOUT, 10, 20, 30) + b'trailer'))
+	assert decoder.decode_batch(batch)['humidity'][-1] == 20
+
+def test_registry():
+	registry = decoders.DecoderRegistry()
+	v1 = registry.register(decoders.StructDecoder('<h', ('temperature',)), tag=('firmware', '1'))
+	v2 = registry.register(decoders.StructDecoder('<hH', ('temperature', 'humidity')), tag=('firmware', '2'))
+	text = registry.register(lambda p: p.decode(), collection_id='text')
+
+	old = nbiot.Device(id='1', collection_id='sensors', tags={'firmware': '1'})
+	new = nbiot.Device(id='2', collection_id='sensors', tags={'firmware': '2'})
+	chat = nbiot.Device(id='3', collection_id='text')
+	unknown = nbiot.Device(id='4', collection_id='sensors')
+	assert registry.decode(message(new, struct.pack('<hH', 21, 50))) == {'temperature': 21, 'humidity': 50}
+	assert registry.decode(message(chat, b'hello')) == 'hello'
+	with pytest.raises(LookupError):
+		registry.decode(message(unknown, b''))
+
+	batch = nbiot.OutputDataBatch([
+		message(old, struct.pack('<h', 1)),
+		message(new, struct.pack('<hH', 2, 20)),
+		message(chat, b'hi'),
+		message(unknown, b'?'),
+		message(old, struct.pack('<h', 3)),
+	])
+	parts = {decoder: (len(part), decoded) for decoder, part, decoded in registry.decode_batch(batch)}
+	assert parts == {
+		v1: (2, {'temperature': [1, 3]}),
+		v2: (1, {'temperature': [2], 'humidity': [20]}),
+		text: (1, ['hi']),
+	}
+
+	batch = nbiot.OutputDataBatch(message(new, struct.pack('<hH', i, i)) for i in range(3))
+	[(decoder, part, decoded)] = registry.decode_batch(batch)
+	assert decoder is v2 and part is batch
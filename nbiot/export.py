@@ -0,0 +1,200 @@
+from array import array
+import ast
+import importlib.util
+import sys
+import zipfile
+
+from .nbiot import DEFAULT_PAGE_SIZE, Device, OutputDataBatch
+
+DEFAULT_ROW_GROUP_SIZE = 65536
+
+FORMATS = {
+	'.parquet': 'parquet',
+	'.arrow': 'arrow',
+	'.feather': 'arrow',
+	'.ipc': 'arrow',
+	'.npz': 'npz',
+}
+
+def export_collection_data(client, collection_id, path, since=None, until=None, format=None, row_group_size=DEFAULT_ROW_GROUP_SIZE, page_size=DEFAULT_PAGE_SIZE):
+	"""Write the messages received by a collection between since and until to
+	path, newest first, as they are fetched.  Returns the number of rows."""
+	return export(client.iter_collection_data(collection_id, since, until, page_size), path, format, row_group_size)
+
+def export_device_data(client, collection_id, device_id, path, since=None, until=None, format=None, row_group_size=DEFAULT_ROW_GROUP_SIZE, page_size=DEFAULT_PAGE_SIZE):
+	"""Write the messages received from a device between since and until to
+	path, newest first, as they are fetched.  Returns the number of rows."""
+	return export(client.iter_device_data(collection_id, device_id, since, until, page_size), path, format, row_group_size)
+
+def export(messages, path, format=None, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+	"""Write messages to path in chunks of row_group_size rows, so that no more
+	than one chunk is held in memory.  Returns the number of rows written.
+
+	Every chunk has the columns device_id, imsi, received (milliseconds since
+	the epoch) and payload (binary, as one buffer and offsets).  format is
+	'parquet', 'arrow' (the Arrow IPC file format) or 'npz'; by default it is
+	chosen from the file extension, falling back to Parquet when pyarrow is
+	installed and NPZ otherwise."""
+	writer = open_writer(path, format)
+	try:
+		batch = OutputDataBatch()
+		for msg in messages:
+			batch.append(msg)
+			if len(batch) == row_group_size:
+				writer.write(batch)
+				batch.clear()
+		if len(batch) > 0:
+			writer.write(batch)
+	finally:
+		writer.close()
+	return writer.rows
+
+def open_writer(path, format=None):
+	if format is None:
+		format = _format(path)
+	writer = {'parquet': ParquetWriter, 'arrow': ArrowWriter, 'npz': NPZWriter}.get(format)
+	if writer is None:
+		raise ValueError('unknown export format {0!r}'.format(format))
+	return writer(path)
+
+def _format(path):
+	for ext, format in FORMATS.items():
+		if str(path).endswith(ext):
+			return format
+	if importlib.util.find_spec('pyarrow') is None:
+		return 'npz'
+	return 'parquet'
+
+
+class ParquetWriter:
+	"""Write OutputDataBatches to a Parquet file, one row group per batch."""
+	def __init__(self, path):
+		import pyarrow.parquet
+		self.rows = 0
+		self._writer = pyarrow.parquet.ParquetWriter(path, _arrow_schema())
+
+	def write(self, batch):
+		self._writer.write_table(_arrow_table(batch), row_group_size=len(batch))
+		self.rows += len(batch)
+
+	def close(self):
+		self._writer.close()
+
+class ArrowWriter:
+	"""Write OutputDataBatches to an Arrow IPC file, one record batch per batch."""
+	def __init__(self, path):
+		import pyarrow.ipc
+		self.rows = 0
+		self._writer = pyarrow.ipc.new_file(path, _arrow_schema())
+
+	def write(self, batch):
+		self._writer.write_table(_arrow_table(batch))
+		self.rows += len(batch)
+
+	def close(self):
+		self._writer.close()
+
+def _arrow_schema():
+	import pyarrow as pa
+	return pa.schema([
+		('device_id', pa.string()),
+		('imsi', pa.string()),
+		('received', pa.timestamp('ms', tz='UTC')),
+		('payload', pa.large_binary()),
+	])
+
+def _arrow_table(batch):
+	import pyarrow as pa
+	n = len(batch)
+	# The numeric columns and the payload buffer are handed to Arrow without
+	# copying; only the device columns are expanded from the distinct devices.
+	index = pa.Array.from_buffers(pa.int32(), n, [None, pa.py_buffer(_little_endian(array('i', batch.device_index)))])
+	device_id = pa.array([d.id for d in batch.devices], pa.string()).take(index)
+	imsi = pa.array([d.imsi for d in batch.devices], pa.string()).take(index)
+	received = pa.Array.from_buffers(pa.timestamp('ms', tz='UTC'), n, [None, pa.py_buffer(_little_endian(batch.received))])
+	payload = pa.Array.from_buffers(pa.large_binary(), n, [None, pa.py_buffer(_little_endian(batch.offsets)), pa.py_buffer(batch.payloads)])
+	return pa.Table.from_arrays([device_id, imsi, received, payload], schema=_arrow_schema())
+
+
+class NPZWriter:
+	"""Write OutputDataBatches to a NumPy .npz archive without needing NumPy.
+	Batch i is stored as the arrays chunk<i>/received (datetime64[ms]),
+	chunk<i>/payload (uint8), chunk<i>/offsets (int64), chunk<i>/device (int32
+	indexes into the distinct devices of the chunk) and chunk<i>/device_id and
+	chunk<i>/imsi (one string per distinct device)."""
+	def __init__(self, path):
+		self.rows = 0
+		self.chunks = 0
+		self._zip = zipfile.ZipFile(path, 'w', allowZip64=True)
+
+	def write(self, batch):
+		prefix = 'chunk{0}/'.format(self.chunks)
+		self._array(prefix + 'received', '<M8[ms]', len(batch), _little_endian(batch.received))
+		self._array(prefix + 'payload', '|u1', len(batch.payloads), batch.payloads)
+		self._array(prefix + 'offsets', '<i8', len(batch.offsets), _little_endian(batch.offsets))
+		self._array(prefix + 'device', '<i4', len(batch), _little_endian(array('i', batch.device_index)))
+		self._strings(prefix + 'device_id', [d.id for d in batch.devices])
+		self._strings(prefix + 'imsi', [d.imsi or '' for d in batch.devices])
+		self.chunks += 1
+		self.rows += len(batch)
+
+	def close(self):
+		self._zip.close()
+
+	def _strings(self, name, values):
+		width = max([1] + [len(v) for v in values])
+		data = b''.join(v.ljust(width, '\0').encode('utf-32-le') for v in values)
+		self._array(name, '<U{0}'.format(width), len(values), data)
+
+	def _array(self, name, descr, n, data):
+		with self._zip.open(name + '.npy', 'w', force_zip64=True) as f:
+			f.write(_npy_header(descr, n))
+			# Python 3.7's zipfile counts len(data), which is in items for arrays.
+			f.write(memoryview(data).cast('B'))
+
+def read_npz(path):
+	"""Yield the chunks of an archive written by NPZWriter as OutputDataBatches."""
+	with zipfile.ZipFile(path) as z:
+		i = 0
+		while 'chunk{0}/received.npy'.format(i) in z.NameToInfo:
+			read = lambda column: _npy_parse(z.read('chunk{0}/{1}.npy'.format(i, column)))
+			batch = OutputDataBatch()
+			batch.received = _npy_array('q', read('received'))
+			batch.payloads = bytearray(read('payload')[1])
+			batch.offsets = _npy_array('q', read('offsets'))
+			batch.device_index = array('l', _npy_array('i', read('device')))
+			ids = _npy_strings(read('device_id'))
+			imsis = _npy_strings(read('imsi'))
+			batch.devices = [Device(id=id, imsi=imsi or None) for id, imsi in zip(ids, imsis)]
+			batch._device_ids = {id: j for j, id in enumerate(ids)}
+			yield batch
+			i += 1
+
+def _npy_header(descr, n):
+	header = "{{'descr': '{0}', 'fortran_order': False, 'shape': ({1},), }}".format(descr, n)
+	# Version 1.0: magic, version, little-endian header length and the header
+	# padded with spaces and a newline to a multiple of 64 bytes.
+	header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+	return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin-1')
+
+def _npy_parse(data):
+	n = int.from_bytes(data[8:10], 'little')
+	return ast.literal_eval(data[10:10+n].decode('latin-1')), memoryview(data)[10+n:]
+
+def _npy_array(typecode, npy):
+	a = array(typecode)
+	a.frombytes(npy[1])
+	return _little_endian(a)
+
+def _npy_strings(npy):
+	header, body = npy
+	width = int(header['descr'][2:])
+	text = bytes(body).decode('utf-32-le')
+	return [text[i:i+width].rstrip('\0') for i in range(0, len(text), width)]
+
+def _little_endian(a):
+	if sys.byteorder == 'little':
+		return a
+	a = array(a.typecode, a)
+	a.byteswap()
+	return a
@@ -0,0 +1,61 @@
+from datetime import datetime, timezone
+import pytest
+
+from nbiot import nbiot
+from nbiot import export
+from nbiot.nbiot_test import data_message
+
+MESSAGES = [data_message(str(i % 3), bytes([i] * (i % 5)), 1546300800000 + i) for i in range(10)]
+
+def test_npz(tmp_path):
+	path = tmp_path / 'data.npz'
+	assert export.export(MESSAGES, path, row_group_size=4) == len(MESSAGES)
+	chunks = list(export.read_npz(path))
+	assert [len(c) for c in chunks] == [4, 4, 2]
+	msgs = [m for c in chunks for m in c]
+	assert [m.device.id for m in msgs] == [m.device.id for m in MESSAGES]
+	assert [m.payload for m in msgs] == [m.payload for m in MESSAGES]
+	assert [m.received_ms for m in msgs] == [m.received_ms for m in MESSAGES]
+
+def test_npz_numpy(tmp_path):
+	np = pytest.importorskip('numpy')
+	path = tmp_path / 'data.npz'
+	export.export(MESSAGES, path, row_group_size=4)
+	with np.load(path) as z:
+		assert z['chunk0/received'][0] == np.datetime64(1546300800000, 'ms')
+		offsets, payload = z['chunk2/offsets'], z['chunk2/payload']
+		assert payload[offsets[1]:offsets[2]].tobytes() == MESSAGES[9].payload
+		assert list(z['chunk1/device_id'][z['chunk1/device']]) == [m.device.id for m in MESSAGES[4:8]]
+
+@pytest.mark.parametrize('name', ['data.parquet', 'data.arrow'])
+def test_arrow(tmp_path, name):
+	pytest.importorskip('pyarrow')
+	import pyarrow.ipc
+	import pyarrow.parquet
+	path = tmp_path / name
+	export.export(MESSAGES, path, row_group_size=4)
+	if name.endswith('.parquet'):
+		assert pyarrow.parquet.ParquetFile(path).num_row_groups == 3
+		table = pyarrow.parquet.read_table(path)
+	else:
+		table = pyarrow.ipc.open_file(path).read_all()
+	assert table.column('device_id').to_pylist() == [m.device.id for m in MESSAGES]
+	assert table.column('payload').to_pylist() == [m.payload for m in MESSAGES]
+	assert table.column('received').to_pylist()[0] == datetime(2019, 1, 1, tzinfo=timezone.utc)
+
+def test_export_collection_data(server, tmp_path):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		device = client.create_device(collection.id, nbiot.Device(imsi='export', imei='export'))
+		for i in range(25):
+			server.inject(collection.id, device.id, bytes([i]), received=1546300800000 + i)
+		path = tmp_path / 'data.npz'
+		assert export.export_collection_data(client, collection.id, path, format='npz', row_group_size=10, page_size=7) == 25
+		msgs = [m for c in export.read_npz(path) for m in c]
+		assert [m.payload for m in msgs] == [bytes([i]) for i in reversed(range(25))]
+		assert {m.device.imsi for m in msgs} == {'export'}
+	finally:
+		client.delete_collection(collection.id)
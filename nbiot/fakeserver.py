@@ -0,0 +1,643 @@
+"""An in-process stand-in for the Telenor NB-IoT API.
+
+FakeServer implements the REST routes and the /from websocket used by
+nbiot.Client on top of an in-memory state.  It runs its own event loop on a
+background thread, so it can serve both blocking and asyncio clients:
+
+	with FakeServer() as server:
+		client = nbiot.Client(addr=server.addr, token=server.token)
+		collection = client.create_collection(nbiot.Collection())
+		device = client.create_device(collection.id, nbiot.Device(imsi='1', imei='2'))
+		server.inject(collection.id, device.id, b'hello')
+"""
+import asyncio
+import base64
+import bisect
+from hashlib import sha1
+import itertools
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_TOKEN = 'fake-token'
+DEFAULT_LIMIT = 255
+MAX_LIMIT = 10000
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_STATUS_TEXT = {
+	101: 'Switching Protocols', 200: 'OK', 201: 'Created', 204: 'No Content', 304: 'Not Modified',
+	400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 405: 'Method Not Allowed',
+	409: 'Conflict', 429: 'Too Many Requests', 500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+class FakeServer:
+	"""Serve the NB-IoT API on addr (http://127.0.0.1:<port>).  Requests must
+	carry token in X-API-Token.  Downstream messages to devices fail with 409
+	Conflict unless reachable is set, mirroring devices that have not been
+	online; successfully sent messages are recorded in downstream."""
+	def __init__(self, token=DEFAULT_TOKEN, host='127.0.0.1', port=0, reachable=False, keepalive=None):
+		self.token = token
+		self.host = host
+		self.port = port
+		self.reachable = reachable
+		self.keepalive = keepalive
+		self.requests = 0
+		self.throttled = 0
+		self.connections = 0
+		self.downstream = []
+		self.teams = {}
+		self.collections = {}
+		self.devices = {}
+		self.outputs = {}
+		self.invites = {}
+		self._messages = {}
+		self._subscribers = set()
+		self._handlers = {}
+		self._throttle = 0
+		self._retry_after = 0
+		self._fail = 0
+		self._fail_status = 503
+		self._ids = itertools.count(1)
+		self._user = _member('fake-user', 'admin')
+		self._loop = None
+		self._thread = None
+		self._server = None
+		self._routes = self._make_routes()
+		self._private_team = self._new_team()['teamId']
+
+	@property
+	def addr(self):
+		return 'http://{0}:{1}'.format(self.host, self.port)
+
+	def start(self):
+		self._loop = asyncio.new_event_loop()
+		started = threading.Event()
+		def run():
+			asyncio.set_event_loop(self._loop)
+			self._server = self._loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+			self.port = self._server.sockets[0].getsockname()[1]
+			started.set()
+			self._loop.run_forever()
+		self._thread = threading.Thread(target=run, name='nbiot-fakeserver', daemon=True)
+		self._thread.start()
+		started.wait()
+		return self
+
+	def stop(self):
+		if self._loop is None:
+			return
+		self._call(self._shutdown())
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._thread.join()
+		self._loop.close()
+		self._loop = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	def inject(self, collection_id, device_id, payload, received=None):
+		"""Record an upstream message from a device and push it to the open
+		streams.  received is a timestamp in milliseconds, default now."""
+		return self._call(self._inject(collection_id, device_id, payload, received))
+
+	def generate(self, collection_id, rate, count, payload=b'', device_ids=None):
+		"""Inject count messages at rate messages per second, round robin over
+		device_ids (default all devices in the collection).  Returns a
+		concurrent.futures.Future that completes when all have been sent."""
+		if device_ids is None:
+			device_ids = [id for id, d in self.devices.items() if d['collectionId'] == collection_id]
+		return asyncio.run_coroutine_threadsafe(self._generate(collection_id, rate, count, payload, device_ids), self._loop)
+
+	def drop_streams(self):
+		"""Close every open websocket as the server would when restarting."""
+		self._call(self._drop_streams())
+
+	def throttle(self, count, retry_after=0):
+		"""Answer the next count REST requests with 429 Too Many Requests and
+		a Retry-After header of retry_after seconds."""
+		self._retry_after = retry_after
+		self._throttle = count
+
+	def fail(self, count, status=503):
+		"""Answer the next count REST requests with status, as an overloaded
+		server or proxy would."""
+		self._fail_status = status
+		self._fail = count
+
+	def _call(self, coro):
+		return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+	async def _shutdown(self):
+		await self._drop_streams()
+		self._server.close()
+		await self._server.wait_closed()
+		# Closing the connections ends the handlers waiting for a request;
+		# cancelling them instead leaves tracebacks in the loop's log.
+		for writer in self._handlers.values():
+			writer.close()
+		if self._handlers:
+			await asyncio.wait(list(self._handlers), timeout=1)
+
+	async def _inject(self, collection_id, device_id, payload, received):
+		if received is None:
+			received = int(time.time() * 1000)
+		device = self.devices[device_id]
+		msg = {
+			'type': 'data',
+			'device': dict(device, tags=dict(device['tags'])),
+			'payload': base64.b64encode(payload).decode('ascii'),
+			'received': received,
+		}
+		times, msgs = self._messages.setdefault(collection_id, ([], []))
+		i = bisect.bisect_right(times, received)
+		times.insert(i, received)
+		msgs.insert(i, msg)
+		frame = None
+		for sub in self._subscribers:
+			if sub.collection_id == collection_id and sub.device_id in (None, device_id):
+				if frame is None:
+					frame = _ws_frame(0x1, json.dumps(msg).encode())
+				sub.send(frame)
+		return msg
+
+	async def _generate(self, collection_id, rate, count, payload, device_ids):
+		start = time.monotonic()
+		for i in range(count):
+			await self._inject(collection_id, device_ids[i % len(device_ids)], payload, None)
+			delay = start + (i + 1) / rate - time.monotonic()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			elif i % 100 == 99:
+				await asyncio.sleep(0)
+
+	async def _drop_streams(self):
+		for sub in list(self._subscribers):
+			sub.close(1001)
+
+	async def _serve(self, reader, writer):
+		self.connections += 1
+		task = asyncio.current_task()
+		self._handlers[task] = writer
+		try:
+			while True:
+				try:
+					head = await reader.readuntil(b'\r\n\r\n')
+				except (asyncio.IncompleteReadError, ConnectionError):
+					return
+				lines = head.decode('latin-1').split('\r\n')
+				method, target, _ = lines[0].split(' ', 2)
+				headers = {}
+				for line in lines[1:]:
+					if line:
+						k, v = line.split(':', 1)
+						headers[k.strip().lower()] = v.strip()
+				body = b''
+				if 'content-length' in headers:
+					body = await reader.readexactly(int(headers['content-length']))
+				self.requests += 1
+
+				url = urlsplit(target)
+				if url.path.endswith('/from') and headers.get('upgrade', '').lower() == 'websocket':
+					await self._websocket(url.path[:-len('/from')], headers, reader, writer)
+					return
+				if self._throttle > 0:
+					self._throttle -= 1
+					self.throttled += 1
+					status, x, extra = _error(429, 'too many requests')
+					extra['Retry-After'] = str(self._retry_after)
+				elif self._fail > 0:
+					self._fail -= 1
+					status, x, extra = _error(self._fail_status, 'service unavailable')
+				else:
+					status, x, extra = self._handle(method, url.path, parse_qs(url.query), headers, body)
+				content = b'' if x is None else json.dumps(x).encode()
+				if status == 200 and method == 'GET' and content:
+					etag = '"{0}"'.format(sha1(content).hexdigest())
+					extra = dict(extra, ETag=etag)
+					if headers.get('if-none-match') == etag:
+						status, content = 304, b''
+				_write_response(writer, status, content, extra)
+				await writer.drain()
+				if headers.get('connection', '').lower() == 'close':
+					return
+		finally:
+			self._handlers.pop(task, None)
+			writer.close()
+
+	def _handle(self, method, path, query, headers, body):
+		if self.token is not None and headers.get('x-api-token') != self.token:
+			return _error(401, 'invalid API token')
+		for m, pattern, handler in self._routes:
+			match = pattern.fullmatch(path)
+			if match is None:
+				continue
+			if m != method:
+				continue
+			try:
+				x = json.loads(body) if body else {}
+				return handler(*match.groups(), x=x, query=query)
+			except _HTTPError as err:
+				return _error(err.status, err.message)
+			except (KeyError, ValueError, TypeError) as err:
+				return _error(400, 'bad request: {0!r}'.format(err))
+		if any(pattern.fullmatch(path) for _, pattern, _ in self._routes):
+			return _error(405, 'method not allowed')
+		return _error(404, 'not found')
+
+	def _make_routes(self):
+		id = r'([^/]+)'
+		routes = [
+			('GET', '/', lambda **kw: (200, {}, {})),
+			('GET', '/system', self._system),
+			('GET', '/teams', self._teams),
+			('POST', '/teams', self._create_team),
+			('POST', '/teams/accept', self._accept_invite),
+			('GET', '/teams/'+id, self._team),
+			('PATCH', '/teams/'+id, self._update_team),
+			('DELETE', '/teams/'+id, self._delete_team),
+			('PATCH', '/teams/{0}/members/{0}'.format(id), self._update_member),
+			('DELETE', '/teams/{0}/members/{0}'.format(id), self._delete_member),
+			('DELETE', '/teams/{0}/tags/{0}'.format(id), self._delete_tag(self.teams)),
+			('GET', '/teams/{0}/invites'.format(id), self._invites),
+			('POST', '/teams/{0}/invites'.format(id), self._create_invite),
+			('GET', '/teams/{0}/invites/{0}'.format(id), self._invite),
+			('DELETE', '/teams/{0}/invites/{0}'.format(id), self._delete_invite),
+			('GET', '/collections', self._collections),
+			('POST', '/collections', self._create_collection),
+			('GET', '/collections/'+id, self._collection),
+			('PATCH', '/collections/'+id, self._update_collection),
+			('DELETE', '/collections/'+id, self._delete_collection),
+			('DELETE', '/collections/{0}/tags/{0}'.format(id), self._delete_tag(self.collections)),
+			('GET', '/collections/{0}/data'.format(id), self._data),
+			('POST', '/collections/{0}/to'.format(id), self._broadcast),
+			('GET', '/collections/{0}/devices'.format(id), self._devices),
+			('POST', '/collections/{0}/devices'.format(id), self._create_device),
+			('GET', '/collections/{0}/devices/{0}'.format(id), self._device),
+			('PATCH', '/collections/{0}/devices/{0}'.format(id), self._update_device),
+			('DELETE', '/collections/{0}/devices/{0}'.format(id), self._delete_device),
+			('DELETE', '/collections/{0}/devices/{0}/tags/{0}'.format(id), self._delete_child_tag(self.devices)),
+			('GET', '/collections/{0}/devices/{0}/data'.format(id), self._data),
+			('POST', '/collections/{0}/devices/{0}/to'.format(id), self._send),
+			('GET', '/collections/{0}/outputs'.format(id), self._outputs),
+			('POST', '/collections/{0}/outputs'.format(id), self._create_output),
+			('GET', '/collections/{0}/outputs/{0}'.format(id), self._output),
+			('PATCH', '/collections/{0}/outputs/{0}'.format(id), self._update_output),
+			('DELETE', '/collections/{0}/outputs/{0}'.format(id), self._delete_output),
+			('DELETE', '/collections/{0}/outputs/{0}/tags/{0}'.format(id), self._delete_child_tag(self.outputs)),
+			('GET', '/collections/{0}/outputs/{0}/logs'.format(id), self._output_logs),
+			('GET', '/collections/{0}/outputs/{0}/status'.format(id), self._output_status),
+		]
+		return [(method, re.compile(pattern), handler) for method, pattern, handler in routes]
+
+	def _new_id(self):
+		return '{0:x}'.format(0x100000000 + next(self._ids))
+
+	def _new_team(self):
+		team = {'teamId': self._new_id(), 'members': [self._user], 'tags': {}}
+		self.teams[team['teamId']] = team
+		return team
+
+	def _system(self, x, query):
+		mask = _field_mask(False)
+		return 200, {'defaultFieldMask': mask, 'forcedFieldMask': mask}, {}
+
+	def _teams(self, x, query):
+		return 200, {'teams': list(self.teams.values())}, {}
+	def _team(self, id, x, query):
+		return 200, _get(self.teams, id), {}
+	def _create_team(self, x, query):
+		team = self._new_team()
+		team['tags'].update(x.get('tags') or {})
+		return 201, team, {}
+	def _update_team(self, id, x, query):
+		team = _get(self.teams, id)
+		team['tags'].update(x.get('tags') or {})
+		return 200, team, {}
+	def _delete_team(self, id, x, query):
+		_get(self.teams, id)
+		if any(c['teamId'] == id for c in self.collections.values()):
+			raise _HTTPError(409, 'team has collections')
+		del self.teams[id]
+		return 204, None, {}
+	def _update_member(self, id, user_id, x, query):
+		team = _get(self.teams, id)
+		for m in team['members']:
+			if m['userId'] == user_id:
+				m['role'] = x['role']
+				return 200, m, {}
+		raise _HTTPError(404, 'member not found')
+	def _delete_member(self, id, user_id, x, query):
+		team = _get(self.teams, id)
+		team['members'] = [m for m in team['members'] if m['userId'] != user_id]
+		return 204, None, {}
+
+	def _invites(self, team_id, x, query):
+		_get(self.teams, team_id)
+		return 200, {'invites': [i for t, i in self.invites.values() if t == team_id]}, {}
+	def _invite(self, team_id, code, x, query):
+		t, invite = _get(self.invites, code)
+		if t != team_id:
+			raise _HTTPError(404, 'invite not found')
+		return 200, invite, {}
+	def _create_invite(self, team_id, x, query):
+		_get(self.teams, team_id)
+		invite = {'code': self._new_id(), 'createdAt': int(time.time() * 1000)}
+		self.invites[invite['code']] = (team_id, invite)
+		return 201, invite, {}
+	def _accept_invite(self, x, query):
+		team_id, _ = _get(self.invites, x['code'])
+		# There is only one user, and it is a member of every team.
+		raise _HTTPError(409, 'already a member of the team')
+	def _delete_invite(self, team_id, code, x, query):
+		self._invite(team_id, code, x, query)
+		del self.invites[code]
+		return 204, None, {}
+
+	def _collections(self, x, query):
+		return 200, {'collections': list(self.collections.values())}, {}
+	def _collection(self, id, x, query):
+		return 200, _get(self.collections, id), {}
+	def _create_collection(self, x, query):
+		team_id = x.get('teamId') or self._private_team
+		_get(self.teams, team_id)
+		collection = {
+			'collectionId': self._new_id(),
+			'teamId': team_id,
+			'fieldMask': x.get('fieldMask') or _field_mask(False),
+			'tags': x.get('tags') or {},
+		}
+		self.collections[collection['collectionId']] = collection
+		return 201, collection, {}
+	def _update_collection(self, id, x, query):
+		collection = _get(self.collections, id)
+		if x.get('fieldMask'):
+			collection['fieldMask'] = x['fieldMask']
+		collection['tags'].update(x.get('tags') or {})
+		return 200, collection, {}
+	def _delete_collection(self, id, x, query):
+		_get(self.collections, id)
+		for d in [d for d in self.devices.values() if d['collectionId'] == id]:
+			del self.devices[d['deviceId']]
+		for o in [o for o in self.outputs.values() if o['collectionId'] == id]:
+			del self.outputs[o['outputId']]
+		self._messages.pop(id, None)
+		del self.collections[id]
+		for sub in list(self._subscribers):
+			if sub.collection_id == id:
+				sub.close(1000)
+		return 204, None, {}
+
+	def _devices(self, collection_id, x, query):
+		_get(self.collections, collection_id)
+		return 200, {'devices': [d for d in self.devices.values() if d['collectionId'] == collection_id]}, {}
+	def _device(self, collection_id, id, x, query):
+		return 200, _get_child(self.devices, collection_id, id), {}
+	def _create_device(self, collection_id, x, query):
+		_get(self.collections, collection_id)
+		if not x.get('imsi') or not x.get('imei'):
+			raise _HTTPError(400, 'imsi and imei are required')
+		if any(d['imsi'] == x['imsi'] for d in self.devices.values()):
+			raise _HTTPError(409, 'imsi is already in use')
+		device = {
+			'deviceId': self._new_id(),
+			'collectionId': collection_id,
+			'imsi': x['imsi'],
+			'imei': x['imei'],
+			'tags': x.get('tags') or {},
+		}
+		self.devices[device['deviceId']] = device
+		return 201, device, {}
+	def _update_device(self, collection_id, id, x, query):
+		device = _get_child(self.devices, collection_id, id)
+		for k in ('imsi', 'imei'):
+			if x.get(k):
+				device[k] = x[k]
+		device['tags'].update(x.get('tags') or {})
+		return 200, device, {}
+	def _delete_device(self, collection_id, id, x, query):
+		_get_child(self.devices, collection_id, id)
+		del self.devices[id]
+		return 204, None, {}
+
+	def _outputs(self, collection_id, x, query):
+		_get(self.collections, collection_id)
+		return 200, {'outputs': [o for o in self.outputs.values() if o['collectionId'] == collection_id]}, {}
+	def _output(self, collection_id, id, x, query):
+		return 200, _get_child(self.outputs, collection_id, id), {}
+	def _create_output(self, collection_id, x, query):
+		_get(self.collections, collection_id)
+		output = {
+			'outputId': self._new_id(),
+			'collectionId': collection_id,
+			'type': x['type'],
+			'config': {k: v for k, v in x['config'].items() if v is not None},
+			'enabled': bool(x.get('enabled')),
+			'tags': x.get('tags') or {},
+		}
+		self.outputs[output['outputId']] = output
+		return 201, output, {}
+	def _update_output(self, collection_id, id, x, query):
+		output = _get_child(self.outputs, collection_id, id)
+		output['config'].update({k: v for k, v in (x.get('config') or {}).items() if v is not None})
+		if x.get('enabled') is not None:
+			output['enabled'] = x['enabled']
+		output['tags'].update(x.get('tags') or {})
+		return 200, output, {}
+	def _delete_output(self, collection_id, id, x, query):
+		_get_child(self.outputs, collection_id, id)
+		del self.outputs[id]
+		return 204, None, {}
+	def _output_logs(self, collection_id, id, x, query):
+		_get_child(self.outputs, collection_id, id)
+		return 200, {'logs': []}, {}
+	def _output_status(self, collection_id, id, x, query):
+		_get_child(self.outputs, collection_id, id)
+		return 200, {'errorCount': 0, 'forwarded': 0, 'received': 0, 'retries': 0}, {}
+
+	def _delete_tag(self, objects):
+		def delete(id, name, x, query):
+			_get(objects, id)['tags'].pop(name, None)
+			return 204, None, {}
+		return delete
+	def _delete_child_tag(self, objects):
+		def delete(collection_id, id, name, x, query):
+			_get_child(objects, collection_id, id)['tags'].pop(name, None)
+			return 204, None, {}
+		return delete
+
+	def _data(self, collection_id, device_id=None, x=None, query=None):
+		"""Messages with since <= received < until, newest first.  Zero means
+		no bound."""
+		_get(self.collections, collection_id)
+		since = int(query.get('since', ['0'])[0])
+		until = int(query.get('until', ['0'])[0])
+		limit = int(query.get('limit', ['0'])[0]) or DEFAULT_LIMIT
+		limit = min(limit, MAX_LIMIT)
+		times, msgs = self._messages.get(collection_id, ([], []))
+		lo = bisect.bisect_left(times, since)
+		hi = bisect.bisect_left(times, until) if until else len(times)
+		out = []
+		for i in range(hi - 1, lo - 1, -1):
+			m = msgs[i]
+			if device_id is None or m['device']['deviceId'] == device_id:
+				out.append({k: v for k, v in m.items() if k != 'type'})
+				if len(out) == limit:
+					break
+		return 200, {'messages': out}, {}
+
+	def _send(self, collection_id, device_id, x, query):
+		_get_child(self.devices, collection_id, device_id)
+		if not self.reachable:
+			raise _HTTPError(409, 'device has not been online')
+		self.downstream.append((device_id, x['port'], base64.b64decode(x['payload'])))
+		return 204, None, {}
+	def _broadcast(self, collection_id, x, query):
+		_get(self.collections, collection_id)
+		devices = [d for d in self.devices.values() if d['collectionId'] == collection_id]
+		if self.reachable:
+			for d in devices:
+				self.downstream.append((d['deviceId'], x['port'], base64.b64decode(x['payload'])))
+			return 200, {'sent': len(devices), 'failed': 0, 'errors': []}, {}
+		errors = [{'deviceId': d['deviceId'], 'message': 'device has not been online'} for d in devices]
+		return 200, {'sent': 0, 'failed': len(devices), 'errors': errors}, {}
+
+	async def _websocket(self, path, headers, reader, writer):
+		if self.token is not None and headers.get('x-api-token') != self.token:
+			status, x, extra = _error(401, 'invalid API token')
+			_write_response(writer, status, json.dumps(x).encode(), extra)
+			return
+		match = re.fullmatch(r'/collections/([^/]+)(?:/devices/([^/]+))?', path)
+		if match is None or match.group(1) not in self.collections:
+			status, x, extra = _error(404, 'not found')
+			_write_response(writer, status, json.dumps(x).encode(), extra)
+			return
+		accept = base64.b64encode(sha1((headers['sec-websocket-key'] + _WS_GUID).encode()).digest()).decode()
+		_write_response(writer, 101, b'', {
+			'Upgrade': 'websocket',
+			'Connection': 'Upgrade',
+			'Sec-WebSocket-Accept': accept,
+		})
+		sub = _Subscriber(match.group(1), match.group(2), writer)
+		self._subscribers.add(sub)
+		keepalive = None
+		if self.keepalive:
+			keepalive = asyncio.ensure_future(self._send_keepalives(sub))
+		try:
+			await sub.run(reader)
+		finally:
+			self._subscribers.discard(sub)
+			if keepalive is not None:
+				keepalive.cancel()
+
+	async def _send_keepalives(self, sub):
+		frame = _ws_frame(0x1, json.dumps({'type': 'KeepAlive'}).encode())
+		while True:
+			await asyncio.sleep(self.keepalive)
+			sub.send(frame)
+
+
+class _Subscriber:
+	def __init__(self, collection_id, device_id, writer):
+		self.collection_id = collection_id
+		self.device_id = device_id
+		self.writer = writer
+		self.closing = False
+
+	def send(self, frame):
+		if not self.closing:
+			self.writer.write(frame)
+
+	def close(self, code):
+		if not self.closing:
+			self.writer.write(_ws_frame(0x8, code.to_bytes(2, 'big')))
+			self.closing = True
+			self.writer.close()
+
+	async def run(self, reader):
+		try:
+			while True:
+				opcode, payload = await _read_ws_frame(reader)
+				if opcode == 0x8:
+					if not self.closing:
+						self.writer.write(_ws_frame(0x8, payload[:2]))
+						self.closing = True
+					return
+				if opcode == 0x9:
+					self.send(_ws_frame(0xA, payload))
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+
+
+class _HTTPError(Exception):
+	def __init__(self, status, message):
+		self.status = status
+		self.message = message
+
+def _error(status, message):
+	return status, {'status': status, 'message': message}, {}
+
+def _get(objects, id):
+	try:
+		return objects[id]
+	except KeyError:
+		raise _HTTPError(404, 'not found')
+
+def _get_child(objects, collection_id, id):
+	x = _get(objects, id)
+	if x['collectionId'] != collection_id:
+		raise _HTTPError(404, 'not found')
+	return x
+
+def _member(user_id, role):
+	return {
+		'userId': user_id,
+		'role': role,
+		'name': 'Fake User',
+		'email': 'fake@example.com',
+		'phone': '',
+		'verifiedEmail': True,
+		'verifiedPhone': False,
+		'connectId': '',
+		'gitHubLogin': '',
+		'authType': 'token',
+		'avatarUrl': '',
+	}
+
+def _field_mask(value):
+	return {'imsi': value, 'imei': value, 'location': value, 'msisdn': value}
+
+def _write_response(writer, status, content, headers):
+	lines = ['HTTP/1.1 {0} {1}'.format(status, _STATUS_TEXT.get(status, ''))]
+	if status != 101:
+		lines.append('Content-Type: application/json')
+		lines.append('Content-Length: {0}'.format(len(content)))
+	lines += ['{0}: {1}'.format(k, v) for k, v in headers.items()]
+	writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + content)
+
+def _ws_frame(opcode, payload):
+	n = len(payload)
+	if n < 126:
+		head = bytes([0x80 | opcode, n])
+	elif n < 1 << 16:
+		head = bytes([0x80 | opcode, 126]) + n.to_bytes(2, 'big')
+	else:
+		head = bytes([0x80 | opcode, 127]) + n.to_bytes(8, 'big')
+	return head + payload
+
+async def _read_ws_frame(reader):
+	b0, b1 = await reader.readexactly(2)
+	n = b1 & 0x7f
+	if n == 126:
+		n = int.from_bytes(await reader.readexactly(2), 'big')
+	elif n == 127:
+		n = int.from_bytes(await reader.readexactly(8), 'big')
+	mask = await reader.readexactly(4) if b1 & 0x80 else None
+	payload = await reader.readexactly(n)
+	if mask is not None:
+		payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+	return b0 & 0x0f, payload
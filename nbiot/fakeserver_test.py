@@ -0,0 +1,12 @@
+import logging
+
+from nbiot import nbiot
+from nbiot.fakeserver import FakeServer
+
+def test_stop_with_idle_connections(caplog):
+	caplog.set_level(logging.ERROR, logger='asyncio')
+	with FakeServer() as server:
+		client = nbiot.Client(addr=server.addr, token=server.token)
+		client.collections()
+	client.close()
+	assert not caplog.records
@@ -0,0 +1,118 @@
+import bisect
+import threading
+
+from .nbiot import Instrumentation
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DEFAULT_LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+class Counter:
+	"""A monotonically increasing value per label set."""
+	def __init__(self, name, help, labels):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.values = {}
+		self._lock = threading.Lock()
+
+	def inc(self, labels, value=1):
+		with self._lock:
+			self.values[labels] = self.values.get(labels, 0) + value
+
+	def render(self):
+		lines = _header(self, 'counter')
+		for labels, value in sorted(self.values.items()):
+			lines.append('{0}{1} {2}'.format(self.name, _labels(self.labels, labels), value))
+		return lines
+
+class Histogram:
+	"""Observations counted into cumulative buckets per label set."""
+	def __init__(self, name, help, labels, buckets):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = tuple(buckets)
+		self.values = {}
+		self._lock = threading.Lock()
+
+	def observe(self, labels, value):
+		i = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			counts = self.values.get(labels)
+			if counts is None:
+				# One count per bucket, +Inf, then the sum.
+				counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+			counts[i] += 1
+			counts[-1] += value
+
+	def render(self):
+		lines = _header(self, 'histogram')
+		names = self.labels + ('le',)
+		for labels, counts in sorted(self.values.items()):
+			total = 0
+			for bound, count in zip(self.buckets + ('+Inf',), counts):
+				total += count
+				lines.append('{0}_bucket{1} {2}'.format(self.name, _labels(names, labels + (bound,)), total))
+			lines.append('{0}_sum{1} {2}'.format(self.name, _labels(self.labels, labels), counts[-1]))
+			lines.append('{0}_count{1} {2}'.format(self.name, _labels(self.labels, labels), total))
+		return lines
+
+class PrometheusInstrumentation(Instrumentation):
+	"""Instrumentation that keeps Prometheus-style counters and histograms of
+	requests, stream connections and stream messages.  render returns them in
+	the Prometheus text exposition format, ready to be served on /metrics."""
+	def __init__(self, prefix='nbiot', latency_buckets=DEFAULT_LATENCY_BUCKETS, lag_buckets=DEFAULT_LAG_BUCKETS):
+		request = ('method', 'path')
+		self.requests = Counter(prefix+'_requests_total', 'REST requests by status.', request + ('status',))
+		self.request_errors = Counter(prefix+'_request_errors_total', 'REST requests that raised.', request + ('error',))
+		self.request_latency = Histogram(prefix+'_request_duration_seconds', 'REST request latency.', request, latency_buckets)
+		self.response_bytes = Counter(prefix+'_response_bytes_total', 'REST response body bytes.', request)
+		self.retries = Counter(prefix+'_request_retries_total', 'REST request retries.', request)
+		self.cache_hits = Counter(prefix+'_cache_hits_total', 'REST requests served from the cache.', request)
+		self.connects = Counter(prefix+'_stream_connects_total', 'Stream connection attempts.', ('path', 'error'))
+		self.connect_latency = Histogram(prefix+'_stream_connect_duration_seconds', 'Stream connection latency.', ('path',), latency_buckets)
+		self.messages = Counter(prefix+'_stream_messages_total', 'Stream messages received.', ('path',))
+		self.message_bytes = Counter(prefix+'_stream_bytes_total', 'Stream message bytes received.', ('path',))
+		self.message_lag = Histogram(prefix+'_stream_lag_seconds', 'Delay from the server receiving a message to the client reading it.', ('path',), lag_buckets)
+
+	def on_request(self, event):
+		labels = (event.method, event.path)
+		self.requests.inc(labels + (str(event.status or ''),))
+		self.request_latency.observe(labels, event.latency)
+		if event.error is not None:
+			self.request_errors.inc(labels + (event.error,))
+		if event.size:
+			self.response_bytes.inc(labels, event.size)
+		if event.retries:
+			self.retries.inc(labels, event.retries)
+		if event.cached:
+			self.cache_hits.inc(labels)
+
+	def on_connect(self, event):
+		self.connects.inc((event.path, event.error or ''))
+		self.connect_latency.observe((event.path,), event.latency)
+
+	def on_message(self, event):
+		labels = (event.path,)
+		self.messages.inc(labels)
+		self.message_bytes.inc(labels, event.size)
+		self.message_lag.observe(labels, event.lag)
+
+	def metrics(self):
+		return [
+			self.requests, self.request_errors, self.request_latency, self.response_bytes, self.retries, self.cache_hits,
+			self.connects, self.connect_latency, self.messages, self.message_bytes, self.message_lag,
+		]
+
+	def render(self):
+		lines = []
+		for m in self.metrics():
+			lines += m.render()
+		return '\n'.join(lines) + '\n'
+
+def _header(metric, kind):
+	return ['# HELP {0} {1}'.format(metric.name, metric.help), '# TYPE {0} {1}'.format(metric.name, kind)]
+
+def _labels(names, values):
+	pairs = ['{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in zip(names, values)]
+	return '{' + ','.join(pairs) + '}'
@@ -0,0 +1,30 @@
+import pytest
+
+from nbiot import nbiot
+from nbiot import metrics
+
+@pytest.mark.asyncio
+async def test_prometheus_instrumentation(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	inst = metrics.PrometheusInstrumentation()
+	client = nbiot.Client(instrumentation=inst)
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		device = client.create_device(collection.id, nbiot.Device(imsi='metrics', imei='metrics'))
+		with pytest.raises(nbiot.ClientError):
+			client.device(collection.id, '0')
+
+		stream = await client.collection_output_stream(collection.id)
+		server.inject(collection.id, device.id, b'hello')
+		await stream.recv()
+		await stream.close()
+	finally:
+		client.delete_collection(collection.id)
+
+	text = inst.render()
+	assert 'nbiot_requests_total{method="GET",path="/collections/{collection_id}/devices/{device_id}",status="404"} 1' in text
+	assert 'nbiot_request_errors_total{method="GET",path="/collections/{collection_id}/devices/{device_id}",error="ClientError"} 1' in text
+	assert 'nbiot_request_duration_seconds_count{method="POST",path="/collections"} 1' in text
+	assert 'nbiot_stream_connects_total{path="/collections/{collection_id}",error=""} 1' in text
+	assert 'nbiot_stream_messages_total{path="/collections/{collection_id}"} 1' in text
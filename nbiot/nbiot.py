@@ -1,25 +1,108 @@
-import asyncio
+from array import array
 import base64
-from datetime import datetime
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
+import heapq
 import json
 import os
-
-import requests
+import random
+import threading
+import time
 from urllib.parse import urlparse
-import websockets
+
+# requests, websockets, asyncio and concurrent.futures are imported where
+# they are first needed, which keeps importing this module cheap for short
+# lived processes.
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.2
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+RETRY_METHODS = frozenset(['GET', 'DELETE'])
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+DEFAULT_PAGE_SIZE = 1000
+# The data endpoint returns at most this many messages per request.
+MAX_PAGE_SIZE = 10000
+DEFAULT_SHARD = timedelta(hours=1)
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 60
+DEFAULT_RATE = 10
+RATE_RECOVERY = 0.01
+MIN_RATE_FRACTION = 0.05
+DEFAULT_WORKERS = 8
+
+RECONNECT_BACKOFF = 0.5
+RECONNECT_MAX_BACKOFF = 30
+DEDUPE_WINDOW = 4096
+DEFAULT_BATCH_SIZE = 1000
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
 
 class Client:
 	"""Construct a new client.  If addr or teken is not provided, the default
 	configuration is used.  The default configuration can be specified in a
 	configuration file (~/.telenor-nbiot) or through environment variables.  The config
 	file is expected to contain a "address=<value>" line and/or a "token=<value>"
-	line.  The environment variables are TELENOR_NBIOT_ADDRESS and TELENOR_NBIOT_TOKEN"""
-	def __init__(self, addr=None, token=None):
+	line.  The environment variables are TELENOR_NBIOT_ADDRESS and TELENOR_NBIOT_TOKEN
+
+	Requests are sent through a pooled keep-alive session.  pool_size bounds the
+	number of connections kept open, timeout is a (connect, read) tuple in seconds
+	and retries is the number of times idempotent requests (GET and DELETE) are
+	retried with exponential backoff on connection errors and 5xx responses.
+
+	A client can be shared by any number of threads.  At most pool_size
+	requests are in flight at once; further threads wait for a free connection
+	rather than opening and discarding extra ones, so size the pool to the
+	number of worker threads.  The cache, rate limiter and instrumentation only
+	lock around in-memory bookkeeping, never while waiting for the network.
+	close must not be called while other threads are still using the client.
+
+	If a Cache is given, teams, collections, devices and outputs are read
+	through it and invalidated by the methods that modify them.  If an
+	Instrumentation is given it is notified of every request, stream
+	connection and stream message.
+
+	The constructor pings the server unless lazy is set, in which case nothing
+	is connected or imported until the first request and connection errors
+	are raised from that request instead.
+
+	codec encodes and decodes request bodies, responses and stream messages;
+	the default is orjson when it is installed and the json module otherwise.
+
+	If a RateLimiter is given every request waits for it, and idempotent
+	requests answered with 429 Too Many Requests are retried after slowing
+	the limiter down."""
+	def __init__(self, addr=None, token=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, cache=None, instrumentation=None, lazy=False, codec=None, rate_limiter=None):
 		if addr is None or token is None:
 			addr, token = addressTokenFromConfig(CONFIG_FILE)
 		self.addr = addr
 		self.token = token
-		self.ping()
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.retries = retries
+		self.cache = cache
+		self.instrumentation = instrumentation
+		self.codec = codec or default_codec()
+		self.rate_limiter = rate_limiter
+		self._session = None
+		self._session_lock = threading.Lock()
+		self._registries = {}
+		if not lazy:
+			self.ping()
+
+	def close(self):
+		with self._session_lock:
+			if self._session is not None:
+				self._session.close()
+				self._session = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
 
 	def ping(self):
 		try:
@@ -27,7 +110,7 @@ class Client:
 		except ClientError as err:
 			# A token with restricted access will receive 403 Forbidden from "/"
 			# but that still indicates a succesful connection.
-			if err.http_status_code != requests.codes.forbidden:
+			if err.http_status_code != 403:
 				raise err
 
 	def system_defaults(self):
@@ -89,6 +172,7 @@ class Client:
 		self._request('DELETE', '/collections/{0}/tags/{1}'.format(id, name))
 	def delete_collection(self, id):
 		self._request('DELETE', '/collections/'+id)
+		self._registries.pop(id, None)
 
 	def devices(self, collection_id):
 		x = self._request('GET', '/collections/{0}/devices'.format(collection_id))
@@ -98,14 +182,75 @@ class Client:
 		return Device(json=x)
 	def create_device(self, collection_id, device):
 		x = self._request('POST', '/collections/{0}/devices'.format(collection_id), device)
-		return Device(json=x)
+		return _registered(self._registries.get(collection_id), Device(json=x))
 	def update_device(self, collection_id, device):
 		x = self._request('PATCH', '/collections/{0}/devices/{1}'.format(collection_id, device.id), device)
-		return Device(json=x)
+		return _registered(self._registries.get(collection_id), Device(json=x))
 	def delete_device_tag(self, collection_id, device_id, name):
 		self._request('DELETE', '/collections/{0}/devices/{1}/tags/{2}'.format(collection_id, device_id, name))
+		registry = self._registries.get(collection_id)
+		if registry is not None:
+			registry.remove_tag(device_id, name)
 	def delete_device(self, collection_id, device_id):
 		self._request('DELETE', '/collections/{0}/devices/{1}'.format(collection_id, device_id))
+		registry = self._registries.get(collection_id)
+		if registry is not None:
+			registry.remove(device_id)
+
+	def device_registry(self, collection_id):
+		"""Return the DeviceRegistry of a collection, loading its devices on
+		first use.  From then on messages from the collection's streams and
+		history share the registered Device objects."""
+		registry = self._registries.get(collection_id)
+		if registry is None:
+			registry = DeviceRegistry(collection_id, self.devices(collection_id))
+			registry = self._registries.setdefault(collection_id, registry)
+		return registry
+
+	def create_devices(self, collection_id, devices, workers=DEFAULT_WORKERS):
+		"""Create many devices concurrently.  Returns a BulkResult with the created
+		devices; failures do not stop the rest of the batch."""
+		return self._bulk(lambda d: self.create_device(collection_id, d), devices, workers)
+	def update_devices(self, collection_id, devices, workers=DEFAULT_WORKERS):
+		"""Update many devices concurrently.  Returns a BulkResult with the updated
+		devices; failures do not stop the rest of the batch."""
+		return self._bulk(lambda d: self.update_device(collection_id, d), devices, workers)
+	def delete_devices(self, collection_id, device_ids, workers=DEFAULT_WORKERS):
+		"""Delete many devices concurrently.  Returns a BulkResult with the deleted
+		device IDs; failures do not stop the rest of the batch."""
+		def delete(id):
+			self.delete_device(collection_id, id)
+			return id
+		return self._bulk(delete, device_ids, workers)
+
+	def _bulk(self, fn, items, workers):
+		limit = _AdaptiveLimit(workers)
+		def run(item):
+			attempt = 0
+			while True:
+				with limit:
+					try:
+						return fn(item)
+					except ClientError as err:
+						if err.http_status_code not in THROTTLE_STATUS_CODES or attempt == DEFAULT_RETRIES:
+							raise
+						limit.throttle()
+				time.sleep(RETRY_BACKOFF_FACTOR * 2 ** attempt)
+				attempt += 1
+
+		from concurrent.futures import ThreadPoolExecutor
+		import requests
+
+		result = BulkResult()
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = [(item, executor.submit(run, item)) for item in items]
+			for item, f in futures:
+				try:
+					result.succeeded.append(f.result())
+				except (ClientError, requests.exceptions.RequestException) as err:
+					result.failed.append(item)
+					result.errors.append(BulkError(item, err))
+		return result
 
 	def outputs(self, collection_id):
 		x = self._request('GET', '/collections/{0}/outputs'.format(collection_id))
@@ -131,58 +276,665 @@ class Client:
 		self._request('DELETE', '/collections/{0}/outputs/{1}'.format(collection_id, output_id))
 
 	def collection_data(self, collection_id, since=None, until=None, limit=0):
-		return self._data('/collections/{0}'.format(collection_id))
+		return self._data('/collections/{0}'.format(collection_id), since, until, limit, self._registries.get(collection_id))
 	def device_data(self, collection_id, device_id, since=None, until=None, limit=0):
-		return self._data('/collections/{0}/devices/{1}'.format(collection_id, device_id))
-	def _data(self, path, since=None, until=None, limit=0):
-		since = 0 if since is None else int(since.timestamp() * 1000)
-		until = 0 if until is None else int(until.timestamp() * 1000)
-		x = self._request('GET', '{0}/data?since={1}&until={2}&limit={3}'.format(path, since, until, limit))
-		return [OutputDataMessage(m) for m in x['messages']]
+		return self._data('/collections/{0}/devices/{1}'.format(collection_id, device_id), since, until, limit, self._registries.get(collection_id))
+	def _data(self, path, since=None, until=None, limit=0, registry=None):
+		x = self._request('GET', _data_path(path, _timestamp(since), _timestamp(until), limit))
+		return [_data_message(m, registry) for m in x['messages']]
+
+	def iter_collection_data(self, collection_id, since=None, until=None, page_size=DEFAULT_PAGE_SIZE):
+		"""Iterate over the messages received by a collection between since and
+		until, newest first.  The history is fetched lazily, page_size messages
+		per request."""
+		return self._iter_data('/collections/{0}'.format(collection_id), since, until, page_size, self._registries.get(collection_id))
+	def iter_device_data(self, collection_id, device_id, since=None, until=None, page_size=DEFAULT_PAGE_SIZE):
+		"""Iterate over the messages received from a device between since and
+		until, newest first.  The history is fetched lazily, page_size messages
+		per request."""
+		return self._iter_data('/collections/{0}/devices/{1}'.format(collection_id, device_id), since, until, page_size, self._registries.get(collection_id))
+	def _iter_data(self, path, since, until, page_size, registry=None):
+		for m in self._iter_data_json(path, _timestamp(since), _timestamp(until), page_size):
+			yield _data_message(m, registry)
+	def _iter_data_json(self, path, since, until, page_size):
+		pager = _DataPager(path, since, until, page_size)
+		while not pager.done:
+			x = self._request('GET', pager.path())
+			yield from pager.next(x['messages'])
+
+	def backfill(self, collection_id, since, until=None, shard=DEFAULT_SHARD, per_device=False, workers=DEFAULT_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+		"""Fetch the messages received by a collection between since and until
+		(default now) and yield them oldest first.  The range is split into
+		shards of the given timedelta and, if per_device is set, further into one
+		shard per device.  Up to workers shards are fetched concurrently and at
+		most twice that many are held in memory, except that the shards of one
+		time range are merged before any is yielded, so with more devices than
+		that all of a range's device shards are held."""
+		since = _timestamp(since)
+		until = _timestamp(until) or int(time.time() * 1000)
+		step = int(shard.total_seconds() * 1000)
+		if per_device:
+			paths = ['/collections/{0}/devices/{1}'.format(collection_id, d.id) for d in self.devices(collection_id)]
+		else:
+			paths = ['/collections/{0}'.format(collection_id)]
+
+		def fetch(path, since, until):
+			return list(self._iter_data_json(path, since, until, page_size))
+
+		registry = self._registries.get(collection_id)
+		from concurrent.futures import ThreadPoolExecutor
+		executor = ThreadPoolExecutor(max_workers=workers)
+		# The shards of each time range, oldest first, and how many are held.
+		pending = deque()
+		held = 0
+		try:
+			for start in range(since, until, step):
+				end = min(start + step, until)
+				futures = []
+				pending.append(futures)
+				for path in paths:
+					# Only ranges with every shard submitted can be merged.
+					while held >= 2 * workers and len(pending) > 1:
+						done = pending.popleft()
+						held -= len(done)
+						yield from _merge_shards(done, registry)
+					futures.append(executor.submit(fetch, path, start, end))
+					held += 1
+			while pending:
+				yield from _merge_shards(pending.popleft(), registry)
+		finally:
+			for futures in pending:
+				for f in futures:
+					f.cancel()
+			executor.shutdown(wait=False)
 
 	def send(self, collection_id, device_id, msg):
 		self._request('POST', '/collections/{0}/devices/{1}/to'.format(collection_id, device_id), msg)
 	def broadcast(self, collection_id, msg):
 		x = self._request('POST', '/collections/{0}/to'.format(collection_id), msg)
 		return BroadcastResult(x)
+	def send_many(self, collection_id, messages, workers=DEFAULT_WORKERS):
+		"""Send a different message to each of many devices concurrently.
+		messages is an iterable of (device_id, DownstreamMessage) pairs.  Returns a
+		SendManyResult like BroadcastResult, with a SendError per failed device."""
+		def send(item):
+			device_id, msg = item
+			self.send(collection_id, device_id, msg)
+			return device_id
+		bulk = self._bulk(send, messages, workers)
+		return SendManyResult(bulk.succeeded, [SendError(e.item[0], e.error) for e in bulk.errors])
 
 	def _request(self, method, path, x=None):
-		json = x and x.json()
-		headers = {'X-API-Token': self.token, 'Content-Type': 'application/json'}
-		resp = requests.request(method, self.addr + path, json=json, headers=headers)
+		inst = self.instrumentation
+		if inst is None:
+			return self._send(method, path, x, None)
+		event = RequestEvent(method, _path_template(path))
+		start = time.perf_counter()
+		try:
+			return self._send(method, path, x, event)
+		except Exception as err:
+			event.error = type(err).__name__
+			raise
+		finally:
+			event.latency = time.perf_counter() - start
+			inst.on_request(event)
+
+	def _send(self, method, path, x, event):
+		cache = self.cache
+		if cache is not None and method == 'GET' and _cacheable(path):
+			return self._cached_request(cache, path, event)
+		body = x and self.codec.dumps(x.json())
+		resp = self._http_request(method, path, body)
+		if event is not None:
+			event.observe(resp)
 		if not resp.ok:
 			raise ClientError(resp)
-		if method is not 'DELETE' and resp.content:
-			return resp.json()
-
-	def collection_output_stream(self, id):
-		return self._output_stream('/collections/'+id)
-	def device_output_stream(self, collection_id, device_id):
-		return self._output_stream('/collections/{0}/devices/{1}'.format(collection_id, device_id))
-
-	async def _output_stream(self, path):
-		url = urlparse(self.addr)
-		scheme = 'wss'
-		ssl = True
-		if url.scheme == 'http':
-			scheme = 'ws'
-			ssl = False
-		hostport = url.hostname
-		if url.port is not None:
-			hostport += ":" + url.port
-		ws = await websockets.connect(
-			'{0}://{1}{2}/from'.format(scheme, hostport, path),
-			ssl=ssl,
-			extra_headers=[('X-API-Token', self.token)],
-			origin='http://www.example.com',
-		)
-		return OutputStream(ws)
+		if cache is not None and method != 'GET' and not path.endswith('/to'):
+			cache.invalidate(path)
+		if method != 'DELETE' and resp.content:
+			return self.codec.loads(resp.content)
+
+	def _cached_request(self, cache, path, event):
+		entry, generation = cache.get(path)
+		if entry is not None and entry.fresh():
+			if event is not None:
+				event.cached = True
+				event.size = len(entry.content)
+			return self.codec.loads(entry.content)
+		headers = None
+		if entry is not None and entry.etag is not None:
+			headers = {'If-None-Match': entry.etag}
+		resp = self._http_request('GET', path, headers=headers)
+		if event is not None:
+			event.observe(resp)
+		if resp.status_code == 304 and entry is not None:
+			cache.revalidated(path, entry)
+			return self.codec.loads(entry.content)
+		if not resp.ok:
+			raise ClientError(resp)
+		cache.put(path, resp.content, resp.headers.get('ETag'), generation)
+		return self.codec.loads(resp.content)
+
+	def _http_request(self, method, path, body=None, headers=None):
+		session = self._http()
+		limiter = self.rate_limiter
+		if limiter is None:
+			return session.request(method, self.addr + path, data=body, headers=headers, timeout=self.timeout)
+		route = _path_template(path)
+		attempt = 0
+		while True:
+			time.sleep(limiter.reserve(method, route))
+			resp = session.request(method, self.addr + path, data=body, headers=headers, timeout=self.timeout)
+			if resp.status_code != 429:
+				limiter.succeeded(method, route)
+				return resp
+			limiter.throttled(method, route, _retry_after(resp.headers.get('Retry-After')))
+			if method not in RETRY_METHODS or attempt == self.retries:
+				return resp
+			attempt += 1
+
+	def _http(self):
+		session = self._session
+		if session is None:
+			with self._session_lock:
+				if self._session is None:
+					# With a rate limiter 429 is handled in _http_request rather than
+					# by urllib3 sleeping on Retry-After behind the limiter's back.
+					self._session = _session(self.token, self.pool_size, self.retries, self.rate_limiter is None)
+				session = self._session
+		return session
+
+	def collection_output_stream(self, id, resilient=False, on_frame=None):
+		return self._output_stream('/collections/'+id, resilient, on_frame, self._registries.get(id))
+	def device_output_stream(self, collection_id, device_id, resilient=False, on_frame=None):
+		return self._output_stream('/collections/{0}/devices/{1}'.format(collection_id, device_id), resilient, on_frame, self._registries.get(collection_id))
+
+	def _output_stream(self, path, resilient=False, on_frame=None, registry=None):
+		if not resilient:
+			return _output_stream(self.addr, self.token, path, self.instrumentation, self.codec, on_frame, registry)
+		import asyncio
+		import requests
+
+		async def history(since):
+			fetch = lambda: [_data_message(m, registry) for m in self._iter_data_json(path, since, 0, DEFAULT_PAGE_SIZE)]
+			return await asyncio.get_event_loop().run_in_executor(None, fetch)
+		errors = (ClientError, requests.exceptions.RequestException)
+		connect = lambda: _output_stream(self.addr, self.token, path, self.instrumentation, self.codec, on_frame, registry)
+		return _resilient_output_stream(connect, history, errors)
+
+
+async def _output_stream(addr, token, path, instrumentation=None, codec=None, on_frame=None, registry=None):
+	import websockets
+
+	url = urlparse(addr)
+	scheme = 'wss'
+	ssl = True
+	if url.scheme == 'http':
+		scheme = 'ws'
+		ssl = None
+	hostport = url.hostname
+	if url.port is not None:
+		hostport += ':{0}'.format(url.port)
+	connect = websockets.connect(
+		'{0}://{1}{2}/from'.format(scheme, hostport, path),
+		ssl=ssl,
+		extra_headers=[('X-API-Token', token)],
+		origin='http://www.example.com',
+	)
+	if instrumentation is None:
+		return OutputStream(await connect, codec=codec, on_frame=on_frame, registry=registry)
+	event = ConnectEvent(_path_template(path))
+	start = time.perf_counter()
+	try:
+		ws = await connect
+	except Exception as err:
+		event.error = type(err).__name__
+		raise
+	finally:
+		event.latency = time.perf_counter() - start
+		instrumentation.on_connect(event)
+	return OutputStream(ws, instrumentation, event.path, codec, on_frame, registry)
+
+
+class Instrumentation:
+	"""Receives measurements from a Client.  Subclass it and override the
+	methods of interest; they are called synchronously, so keep them cheap.
+	Paths are templates such as /collections/{collection_id}/devices/{device_id}
+	rather than raw paths, to keep the number of distinct values bounded."""
+	def on_request(self, event):
+		"""Called with a RequestEvent when a REST request completes or fails."""
+
+	def on_connect(self, event):
+		"""Called with a ConnectEvent when a stream websocket has connected or
+		failed to connect."""
+
+	def on_message(self, event):
+		"""Called with a MessageEvent for every data message read from a stream."""
+
+class RequestEvent:
+	"""method and path of a request, its HTTP status (None if no response was
+	received), latency in seconds, response size in bytes, the number of
+	retries, whether it was served from the cache and the class name of the
+	exception raised, if any."""
+	__slots__ = ('method', 'path', 'status', 'latency', 'size', 'retries', 'cached', 'error')
+
+	def __init__(self, method, path):
+		self.method = method
+		self.path = path
+		self.status = None
+		self.latency = 0
+		self.size = 0
+		self.retries = 0
+		self.cached = False
+		self.error = None
+
+	def observe(self, resp):
+		self.status = resp.status_code
+		self.size = len(resp.content)
+		retries = getattr(resp.raw, 'retries', None)
+		if retries is not None:
+			self.retries = len(retries.history)
+
+class ConnectEvent:
+	"""path of a stream, the time in seconds it took to connect and the class
+	name of the exception raised, if any."""
+	__slots__ = ('path', 'latency', 'error')
+
+	def __init__(self, path):
+		self.path = path
+		self.latency = 0
+		self.error = None
+
+class MessageEvent:
+	"""path of a stream, the size of a message frame in bytes and its lag: the
+	seconds between the server receiving the message and the client reading it."""
+	__slots__ = ('path', 'size', 'lag')
+
+	def __init__(self, path, size, lag):
+		self.path = path
+		self.size = size
+		self.lag = lag
+
+_PATH_PARAMS = {
+	'teams': '{team_id}',
+	'members': '{user_id}',
+	'invites': '{code}',
+	'collections': '{collection_id}',
+	'devices': '{device_id}',
+	'outputs': '{output_id}',
+	'tags': '{name}',
+}
+
+def _path_template(path):
+	parts = path.split('?', 1)[0].split('/')
+	for i in range(2, len(parts)):
+		param = _PATH_PARAMS.get(parts[i-1])
+		if param is not None and parts[i] != 'accept':
+			parts[i] = param
+	return '/'.join(parts)
+
+
+class JSONCodec:
+	"""Encodes and decodes JSON with the json module in the standard library."""
+	def dumps(self, x):
+		return json.dumps(x, separators=(',', ':')).encode('utf-8')
+
+	def loads(self, s):
+		return json.loads(s)
+
+class OrjsonCodec:
+	"""Encodes and decodes JSON with orjson, which is several times faster than
+	the json module."""
+	def __init__(self):
+		import orjson
+		self.dumps = orjson.dumps
+		self.loads = orjson.loads
+
+_default_codec = None
+
+def default_codec():
+	"""Return an OrjsonCodec if orjson is installed, otherwise a JSONCodec."""
+	global _default_codec
+	if _default_codec is None:
+		try:
+			_default_codec = OrjsonCodec()
+		except ImportError:
+			_default_codec = JSONCodec()
+	return _default_codec
+
+
+def _timestamp(t):
+	return 0 if t is None else int(t.timestamp() * 1000)
+
+def _data_path(path, since, until, limit):
+	return '{0}/data?since={1}&until={2}&limit={3}'.format(path, since, until, limit)
+
+def _message_key(m):
+	return (m['device']['deviceId'], m['received'], m['payload'])
+
+class _DataPager:
+	"""Walks the data endpoint backwards in time.  Each page ends at the oldest
+	timestamp of the previous one, so the messages at that millisecond are
+	fetched again and the ones already returned are dropped.  A full page that
+	is all one millisecond may hide more messages at it, so the limit is
+	doubled, up to MAX_PAGE_SIZE, until a page brings nothing new; the walk
+	then moves past that millisecond.  Messages beyond MAX_PAGE_SIZE within
+	one millisecond cannot be reached.  The server may return fewer messages
+	than asked for, so paging only stops at an empty page."""
+	def __init__(self, path, since, until, page_size):
+		self.base = path
+		self.since = since
+		self.until = until
+		self.page_size = min(page_size, MAX_PAGE_SIZE)
+		self.limit = self.page_size
+		self.seen = Counter()
+		self.done = False
+
+	def path(self):
+		return _data_path(self.base, self.since, self.until, self.limit)
+
+	def next(self, messages):
+		if not messages:
+			self.done = True
+			return []
+		# Identical messages are counted rather than treated as one.
+		seen = Counter(self.seen)
+		new = []
+		for m in messages:
+			key = _message_key(m)
+			if seen[key] > 0:
+				seen[key] -= 1
+			else:
+				new.append(m)
+		oldest = min(m['received'] for m in messages)
+		if not new:
+			# Everything at the oldest millisecond has been returned.
+			self.limit = self.page_size
+			self.seen = Counter()
+			self.until = oldest
+			self.done = oldest <= self.since
+			return new
+		self.seen = Counter(_message_key(m) for m in messages if m['received'] == oldest)
+		self.until = oldest + 1
+		# The next page must hold the messages seen at the oldest millisecond
+		# and more, or it would look like there is nothing new.
+		if oldest == max(m['received'] for m in messages):
+			self.limit = min(self.limit * 2, MAX_PAGE_SIZE)
+		else:
+			self.limit = min(sum(self.seen.values()) + self.page_size, MAX_PAGE_SIZE)
+		return new
+
+
+def _merge_shards(futures, registry=None):
+	# Each shard is newest first.
+	shards = [reversed(f.result()) for f in futures]
+	for m in heapq.merge(*shards, key=lambda m: m['received']):
+		yield _data_message(m, registry)
+
+
+class _AdaptiveLimit:
+	"""A concurrency limit that halves when the server pushes back and grows
+	back additively as requests succeed."""
+	def __init__(self, limit):
+		self.max = limit
+		self.limit = limit
+		self.active = 0
+		self.cond = threading.Condition()
+
+	def __enter__(self):
+		with self.cond:
+			while self.active >= int(self.limit):
+				self.cond.wait()
+			self.active += 1
+
+	def __exit__(self, *exc):
+		with self.cond:
+			self.active -= 1
+			if exc[0] is None:
+				self.limit = min(self.max, self.limit + 1 / self.limit)
+			self.cond.notify_all()
+
+	def throttle(self):
+		with self.cond:
+			self.limit = max(1, self.limit / 2)
+
+
+def _cacheable(path):
+	if path == '/' or '/data?' in path:
+		return False
+	return not (path.endswith('/logs') or path.endswith('/status'))
+
+class Cache:
+	"""A read-through cache for the metadata responses of a Client, bounded by
+	maxsize entries (least recently used are evicted first) and ttl seconds.
+	Expired entries that came with an ETag are revalidated with If-None-Match
+	instead of being fetched again.  hits, misses and revalidations count the
+	lookups."""
+	def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.revalidations = 0
+		self._entries = OrderedDict()
+		# The keys by their path, and by the path and each of its ancestors,
+		# so that invalidate does not scan every entry.
+		self._paths = {}
+		self._subtrees = {}
+		self._generation = 0
+		self._lock = threading.Lock()
+
+	def get(self, path):
+		with self._lock:
+			entry = self._entries.get(path)
+			if entry is not None and entry.fresh():
+				self._entries.move_to_end(path)
+				self.hits += 1
+			else:
+				self.misses += 1
+			return entry, self._generation
+
+	def put(self, path, content, etag, generation):
+		with self._lock:
+			# Drop responses that raced with an invalidation.
+			if generation != self._generation:
+				return
+			if path not in self._entries:
+				self._index(path)
+			self._entries[path] = _CacheEntry(content, etag, time.monotonic() + self.ttl)
+			self._entries.move_to_end(path)
+			while len(self._entries) > self.maxsize:
+				key, _ = self._entries.popitem(last=False)
+				self._unindex(key)
+
+	def revalidated(self, path, entry):
+		with self._lock:
+			self.revalidations += 1
+			entry.expires = time.monotonic() + self.ttl
+			if path in self._entries:
+				self._entries.move_to_end(path)
+
+	def invalidate(self, path):
+		"""Drop the entries for path, for everything below it and for the
+		listings above it."""
+		with self._lock:
+			self._generation += 1
+			keys = set(self._subtrees.get(path, ()))
+			for p in _ancestors(path):
+				keys.update(self._paths.get(p, ()))
+			for key in keys:
+				del self._entries[key]
+				self._unindex(key)
+
+	def clear(self):
+		with self._lock:
+			self._generation += 1
+			self._entries.clear()
+			self._paths.clear()
+			self._subtrees.clear()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def _index(self, key):
+		path = key.split('?', 1)[0]
+		self._paths.setdefault(path, set()).add(key)
+		for p in _ancestors(path):
+			self._subtrees.setdefault(p, set()).add(key)
+
+	def _unindex(self, key):
+		path = key.split('?', 1)[0]
+		_discard_key(self._paths, path, key)
+		for p in _ancestors(path):
+			_discard_key(self._subtrees, p, key)
+
+def _ancestors(path):
+	"""path and each of its ancestors: /a/b, /a."""
+	while path:
+		yield path
+		path = path.rsplit('/', 1)[0]
+
+def _discard_key(index, path, key):
+	keys = index[path]
+	keys.discard(key)
+	if not keys:
+		del index[path]
+
+class _CacheEntry:
+	__slots__ = ('content', 'etag', 'expires')
+
+	def __init__(self, content, etag, expires):
+		self.content = content
+		self.etag = etag
+		self.expires = expires
+
+	def fresh(self):
+		return time.monotonic() < self.expires
+
+
+def _retry_after(value):
+	if value is None:
+		return None
+	try:
+		return max(0, float(value))
+	except ValueError:
+		pass
+	import email.utils
+	try:
+		when = email.utils.parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	return max(0, when.timestamp() - time.time())
+
+class RateLimiter:
+	"""A token bucket rate limiter that can be shared by any number of clients,
+	threads and tasks.  By default all requests share one bucket allowing rate
+	requests per second with bursts of up to burst requests.  rates gives other
+	(rate, burst) pairs for a verb ('POST'), a route ('/collections/{collection_id}/data')
+	or a verb and route ('GET /collections/{collection_id}/devices'); the most
+	specific match wins.  Routes are path templates as reported to
+	Instrumentation.
+
+	When the server answers 429 the rate of the bucket is halved and, if the
+	response had a Retry-After header, the bucket is paused for that long.
+	Every successful request then recovers a little of the configured rate."""
+	def __init__(self, rate=DEFAULT_RATE, burst=None, rates=None):
+		self._default = _Bucket(rate, burst)
+		self._buckets = {k: _Bucket(*v) for k, v in (rates or {}).items()}
+		self._lock = threading.Lock()
+
+	def reserve(self, method, route):
+		"""Take a token and return the number of seconds to wait before using it."""
+		bucket = self._bucket(method, route)
+		with self._lock:
+			return bucket.reserve(time.monotonic())
+
+	def acquire(self, method, route):
+		"""Block until a request may be sent."""
+		time.sleep(self.reserve(method, route))
+
+	def succeeded(self, method, route):
+		bucket = self._bucket(method, route)
+		if bucket.rate < bucket.max_rate:
+			with self._lock:
+				bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * RATE_RECOVERY)
+
+	def throttled(self, method, route, retry_after=None):
+		bucket = self._bucket(method, route)
+		with self._lock:
+			now = time.monotonic()
+			bucket.rate = max(bucket.max_rate * MIN_RATE_FRACTION, bucket.rate / 2)
+			if retry_after is not None:
+				bucket.paused_until = max(bucket.paused_until, now + retry_after)
+
+	def rate(self, method, route):
+		"""The current rate in requests per second for a verb and route."""
+		return self._bucket(method, route).rate
+
+	def _bucket(self, method, route):
+		buckets = self._buckets
+		if buckets:
+			for key in (method + ' ' + route, route, method):
+				bucket = buckets.get(key)
+				if bucket is not None:
+					return bucket
+		return self._default
+
+class _Bucket:
+	__slots__ = ('rate', 'max_rate', 'burst', 'tokens', 'last', 'paused_until')
+
+	def __init__(self, rate, burst=None):
+		self.rate = rate
+		self.max_rate = rate
+		self.burst = burst or max(1, rate)
+		self.tokens = self.burst
+		self.last = time.monotonic()
+		self.paused_until = 0
+
+	def reserve(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+		self.tokens -= 1
+		delay = 0 if self.tokens >= 0 else -self.tokens / self.rate
+		return max(delay, self.paused_until - now)
+
+
+def _session(token, pool_size, retries, respect_retry_after=True):
+	import requests
+	from requests.adapters import HTTPAdapter
+	from urllib3.util.retry import Retry
+
+	retry = Retry(
+		total=retries,
+		connect=retries,
+		read=retries,
+		status=retries,
+		backoff_factor=RETRY_BACKOFF_FACTOR,
+		status_forcelist=RETRY_STATUS_CODES,
+		allowed_methods=RETRY_METHODS,
+		raise_on_status=False,
+		respect_retry_after_header=respect_retry_after,
+	)
+	adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+	session = requests.Session()
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	session.headers.update({'X-API-Token': token, 'Content-Type': 'application/json'})
+	return session
 
 
 class ClientError(Exception):
-	def __init__(self, resp):
-		self.http_status_code = resp.status_code
-		self.message = resp.text
+	"""An error response from the API.  retry_after is the number of seconds
+	the server asked the client to wait, if any."""
+	def __init__(self, resp=None, http_status_code=None, message=None, retry_after=None):
+		if resp is not None:
+			self.http_status_code = resp.status_code
+			self.message = resp.text
+			self.retry_after = _retry_after(resp.headers.get('Retry-After'))
+			return
+		self.http_status_code = http_status_code
+		self.message = message
+		self.retry_after = retry_after
 
 	def __str__(self):
 		return self.message
@@ -234,11 +986,13 @@ def readConfig(filepath):
 
 
 class SystemDefaults:
+	__slots__ = ('default_field_mask', 'forced_field_mask')
 	def __init__(self, json):
 		self.default_field_mask = FieldMask(json['defaultFieldMask'])
 		self.forced_field_mask = FieldMask(json['forcedFieldMask'])
 
 class FieldMask:
+	__slots__ = ('imsi', 'imei', 'location', 'msisdn')
 	def __init__(self, imsi=None, imei=None, location=None, msisdn=None, json=None):
 		if json is not None:
 			self.imsi = json['imsi']
@@ -260,10 +1014,11 @@ class FieldMask:
 		}
 
 class Team:
+	__slots__ = ('id', 'members', 'tags')
 	def __init__(self, id=None, members=None, tags=None, json=None):
 		if json is not None:
 			self.id = json['teamId']
-			self.members = [Member(m) for m in json.get('members', [])]
+			self.members = [Member(json=m) for m in json.get('members', [])]
 			self.tags = json.get('tags', {})
 			return
 		self.id = id
@@ -279,6 +1034,7 @@ class Team:
 
 
 class Member:
+	__slots__ = ('user_id', 'role', 'name', 'email', 'phone', 'verifiedEmail', 'verifiedPhone', 'connectId', 'gitHubLogin', 'authType', 'avatarUrl')
 	def __init__(
 		self,
 		user_id=None,
@@ -338,6 +1094,7 @@ class Member:
 
 
 class Invite:
+	__slots__ = ('code', 'created_at')
 	def __init__(self, code=None, created_at=None, json=None):
 		if json is not None:
 			self.code = json['code']
@@ -354,6 +1111,7 @@ class Invite:
 
 
 class Collection:
+	__slots__ = ('id', 'team_id', 'field_mask', 'tags')
 	def __init__(self, id=None, team_id=None, field_mask=None, tags=None, json=None):
 		if json is not None:
 			self.id = json['collectionId']
@@ -370,12 +1128,13 @@ class Collection:
 		return {
 			'collectionId': self.id,
 			'teamId': self.team_id,
-			'fieldMask': self.field_mask,
+			'fieldMask': self.field_mask.json() if isinstance(self.field_mask, FieldMask) else self.field_mask,
 			'tags': self.tags,
 		}
 
 
 class Device:
+	__slots__ = ('id', 'collection_id', 'imsi', 'imei', 'tags')
 	def __init__(self, id=None, collection_id=None, imsi=None, imei=None, tags=None, json=None):
 		if json is not None:
 			self.id = json['deviceId']
@@ -399,6 +1158,148 @@ class Device:
 			'tags': self.tags,
 		}
 
+class DeviceRegistry:
+	"""The devices of a collection, indexed by ID, IMSI, IMEI and tag.  There
+	is one Device object per device: messages decoded through the registry
+	share it instead of each building their own, and changes seen in stream
+	messages or made through the client update it in place.  History only
+	adds devices the registry does not know, since its messages carry the
+	device as it was back then.
+
+	Use Client.device_registry to get the registry of a collection, loaded
+	with its devices; the client's streams, history and device methods for
+	that collection then keep it current.  Lookups do not lock; changes are
+	serialized, so a registry can be shared between threads."""
+	def __init__(self, collection_id, devices=()):
+		self.collection_id = collection_id
+		self._lock = threading.Lock()
+		self._devices = {}
+		self._imsi = {}
+		self._imei = {}
+		self._tags = {}
+		self._tag_values = {}
+		# When each device was last changed, in milliseconds since the epoch.
+		self._changed = {}
+		for d in devices:
+			self.add(d)
+
+	def __len__(self):
+		return len(self._devices)
+
+	def __iter__(self):
+		return iter(list(self._devices.values()))
+
+	def __contains__(self, device_id):
+		return device_id in self._devices
+
+	def get(self, device_id):
+		return self._devices.get(device_id)
+
+	def by_imsi(self, imsi):
+		return self._imsi.get(imsi)
+
+	def by_imei(self, imei):
+		return self._imei.get(imei)
+
+	def tagged(self, name, value=None):
+		"""The devices that have the tag name, or that have it set to value if
+		given."""
+		if value is None:
+			index = self._tags.get(name)
+		else:
+			index = self._tag_values.get((name, value))
+		if not index:
+			return []
+		with self._lock:
+			return list(index.values())
+
+	def add(self, device):
+		"""Add a device, or update the registered one with the same ID in
+		place.  Returns the registered Device."""
+		with self._lock:
+			self._changed[device.id] = _now()
+			return self._add(device.id, device.imsi, device.imei, device.tags)
+
+	def remove(self, device_id):
+		with self._lock:
+			d = self._devices.pop(device_id, None)
+			if d is not None:
+				self._unindex(d)
+				del self._changed[d.id]
+
+	def remove_tag(self, device_id, name):
+		with self._lock:
+			d = self._devices.get(device_id)
+			if d is not None and name in d.tags:
+				tags = dict(d.tags)
+				del tags[name]
+				self._changed[d.id] = _now()
+				self._add(d.id, d.imsi, d.imei, tags)
+
+	def intern(self, json, received=None):
+		"""Return the registered Device for device JSON from a message.  If the
+		JSON differs it is applied only when received, the message's receive
+		time in milliseconds, is given and no older than the last change; pass
+		None for messages from history."""
+		id = json['deviceId']
+		d = self._devices.get(id)
+		tags = json.get('tags') or {}
+		if d is not None and (received is None or d.tags == tags and d.imsi == json['imsi'] and d.imei == json['imei']):
+			return d
+		with self._lock:
+			d = self._devices.get(id)
+			# Another thread may have registered it since the lookup above.
+			if d is not None and (received is None or received < self._changed[id]):
+				return d
+			self._changed[id] = received or 0
+			return self._add(id, json['imsi'], json['imei'], tags)
+
+	def _add(self, id, imsi, imei, tags):
+		d = self._devices.get(id)
+		if d is None:
+			d = self._devices[id] = Device(id, self.collection_id)
+		else:
+			self._unindex(d)
+		d.imsi = imsi
+		d.imei = imei
+		d.tags = dict(tags)
+		self._imsi[imsi] = d
+		self._imei[imei] = d
+		for name, value in d.tags.items():
+			self._tags.setdefault(name, {})[id] = d
+			self._tag_values.setdefault((name, value), {})[id] = d
+		return d
+
+	def _unindex(self, d):
+		if self._imsi.get(d.imsi) is d:
+			del self._imsi[d.imsi]
+		if self._imei.get(d.imei) is d:
+			del self._imei[d.imei]
+		for name, value in d.tags.items():
+			_discard(self._tags, name, d.id)
+			_discard(self._tag_values, (name, value), d.id)
+
+def _discard(index, key, id):
+	devices = index.get(key)
+	if devices is not None:
+		devices.pop(id, None)
+		if not devices:
+			del index[key]
+
+def _data_message(json, registry=None, live=False):
+	if registry is None:
+		return OutputDataMessage(json)
+	return OutputDataMessage(json, device=registry.intern(json['device'], json['received'] if live else None))
+
+def _now():
+	return int(time.time() * 1000)
+
+def _registered(registry, device):
+	# The registry keeps its own copy, so the caller may change device freely.
+	if registry is not None:
+		registry.add(device)
+	return device
+
 
 def _output(json):
 	return {
@@ -409,6 +1310,7 @@ def _output(json):
 	}[json['type']](json=json)
 
 class WebHookOutput:
+	__slots__ = ('id', 'collection_id', 'url', 'basic_auth_user', 'basic_auth_pass', 'custom_header_name', 'custom_header_value', 'enabled', 'tags')
 	def __init__(self, id=None, collection_id=None, url=None, basic_auth_user=None, basic_auth_pass=None, custom_header_name=None, custom_header_value=None, enabled=None, tags=None, json=None):
 		if json is not None:
 			cfg = json['config']
@@ -449,6 +1351,7 @@ class WebHookOutput:
 		}
 
 class MQTTOutput:
+	__slots__ = ('id', 'collection_id', 'endpoint', 'disable_cert_check', 'username', 'password', 'client_id', 'topic_name', 'enabled', 'tags')
 	def __init__(self, id=None, collection_id=None, endpoint=None, disable_cert_check=None, username=None, password=None, client_id=None, topic_name=None, enabled=None, tags=None, json=None):
 		if json is not None:
 			cfg = json['config']
@@ -492,6 +1395,7 @@ class MQTTOutput:
 		}
 
 class IFTTTOutput:
+	__slots__ = ('id', 'collection_id', 'key', 'event_name', 'as_is_payload', 'enabled', 'tags')
 	def __init__(self, id=None, collection_id=None, key=None, event_name=None, as_is_payload=None, enabled=None, tags=None, json=None):
 		if json is not None:
 			cfg = json['config']
@@ -526,6 +1430,7 @@ class IFTTTOutput:
 		}
 
 class UDPOutput:
+	__slots__ = ('id', 'collection_id', 'host', 'port', 'enabled', 'tags')
 	def __init__(self, id=None, collection_id=None, host=None, port=None, enabled=None, tags=None, json=None):
 		if json is not None:
 			cfg = json['config']
@@ -557,12 +1462,14 @@ class UDPOutput:
 		}
 
 class OutputLogEntry:
+	__slots__ = ('message', 'timestamp', 'repeated')
 	def __init__(self, json):
 		self.message = json['message']
 		self.timestamp = datetime.utcfromtimestamp(json['timestamp']/1000)
 		self.repeated = json['repeated']
 
 class OutputStatus:
+	__slots__ = ('error_count', 'forwarded', 'received', 'retries')
 	def __init__(self, json):
 		self.error_count = json['errorCount']
 		self.forwarded = json['forwarded']
@@ -571,32 +1478,321 @@ class OutputStatus:
 
 
 class OutputStream:
-	def __init__(self, ws):
+	"""The messages received by a collection or device as they arrive.  recv
+	returns one message, recv_many a batch, and the stream is also an async
+	iterator that ends when the stream is closed.  Frames other than data
+	messages, such as keepalives, are passed to on_frame as decoded JSON.
+	Messages share the Device objects of registry if one is given."""
+	def __init__(self, ws, instrumentation=None, path=None, codec=None, on_frame=None, registry=None):
+		import websockets
+
+		# recv_many reads the frames the websocket has already queued from its
+		# messages deque, which only the legacy protocol of websockets < 14 has.
+		if not hasattr(ws, 'messages'):
+			raise TypeError('OutputStream needs a websockets < 14 connection, got {0}'.format(type(ws).__name__))
 		self.ws = ws
+		self.instrumentation = instrumentation
+		self.path = path
+		self.on_frame = on_frame
+		self.registry = registry
+		self._loads = (codec or default_codec()).loads
+		self._connection_closed = websockets.exceptions.ConnectionClosed
 
 	async def recv(self):
 		try:
 			while True:
-				msg = json.loads(await self.ws.recv())
-				if msg['type'] == 'data':
-					return OutputDataMessage(json=msg)
-		except websockets.exceptions.ConnectionClosed:
+				msg = self._message(await self.ws.recv())
+				if msg is not None:
+					return msg
+		except self._connection_closed:
 			raise OutputStreamClosed()
 
+	async def recv_many(self, max_n=DEFAULT_BATCH_SIZE, timeout=None):
+		"""Wait up to timeout seconds (without limit if None) for a message,
+		then return it together with the messages already received, up to
+		max_n in all.  Returns an empty list if the timeout expires."""
+		import asyncio
+
+		msgs = []
+		try:
+			if timeout is None:
+				msgs.append(await self.recv())
+			else:
+				try:
+					msgs.append(await asyncio.wait_for(self.recv(), timeout))
+				except asyncio.TimeoutError:
+					return msgs
+			# The frames queued by the websocket can be read without waiting.
+			buffered = self.ws.messages
+			while buffered and len(msgs) < max_n:
+				msg = self._message(await self.ws.recv())
+				if msg is not None:
+					msgs.append(msg)
+		except self._connection_closed:
+			pass
+		return msgs
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		try:
+			return await self.recv()
+		except OutputStreamClosed:
+			raise StopAsyncIteration
+
+	def _message(self, frame):
+		msg = self._loads(frame)
+		if msg['type'] != 'data':
+			if self.on_frame is not None:
+				self.on_frame(msg)
+			return None
+		if self.instrumentation is not None:
+			lag = time.time() - msg['received'] / 1000
+			self.instrumentation.on_message(MessageEvent(self.path, len(frame), lag))
+		return _data_message(msg, self.registry, True)
+
 	async def close(self):
-		await self.ws.close()
+		import asyncio
+
+		closing = asyncio.ensure_future(self.ws.close())
+		try:
+			# Discard the frames already queued; the closing handshake cannot
+			# complete while the websocket waits for them to be read.
+			while not closing.done():
+				await self.ws.recv()
+		except (self._connection_closed, RuntimeError):
+			# RuntimeError means another task is reading, which drains them.
+			pass
+		await closing
 
 class OutputStreamClosed(Exception):
 	pass
 
 
+async def _resilient_output_stream(connect, history, history_errors):
+	return ResilientOutputStream(await connect(), connect, history, history_errors)
+
+class ResilientOutputStream:
+	"""An output stream that survives dropped connections.  When the websocket
+	closes it reconnects with jittered exponential backoff, fetches the messages
+	received since the last one it delivered through the history endpoint and
+	delivers those before resuming the live stream.  Messages seen both in the
+	history and on the stream are delivered once.  recv only raises
+	OutputStreamClosed after close has been called.
+
+	connect is a coroutine function returning an OutputStream, history a
+	coroutine function returning the messages received since a timestamp in
+	milliseconds, and history_errors the exceptions history raises on transient
+	failures."""
+	def __init__(self, stream, connect, history, history_errors, max_backoff=RECONNECT_MAX_BACKOFF):
+		self.stream = stream
+		self.max_backoff = max_backoff
+		self.reconnects = 0
+		self._connect = connect
+		self._history = history
+		self._history_errors = history_errors
+		self._last = None
+		self._backlog = deque()
+		self._recent = deque()
+		self._recent_keys = set()
+		self._closed = False
+
+	async def recv(self):
+		while True:
+			if self._closed:
+				raise OutputStreamClosed()
+			if self._backlog:
+				return self._backlog.popleft()
+			if self.stream is None:
+				await self._reconnect()
+				continue
+			try:
+				msg = await self.stream.recv()
+			except OutputStreamClosed:
+				self.stream = None
+				continue
+			if self._deliver(msg):
+				return msg
+
+	async def recv_many(self, max_n=DEFAULT_BATCH_SIZE, timeout=None):
+		"""Like OutputStream.recv_many; the messages recovered after a reconnect
+		are returned first."""
+		while True:
+			if self._closed:
+				raise OutputStreamClosed()
+			if self._backlog:
+				return [self._backlog.popleft() for _ in range(min(max_n, len(self._backlog)))]
+			if self.stream is None:
+				await self._reconnect()
+				continue
+			try:
+				msgs = await self.stream.recv_many(max_n, timeout)
+			except OutputStreamClosed:
+				self.stream = None
+				continue
+			msgs = [m for m in msgs if self._deliver(m)]
+			if msgs or timeout is not None:
+				return msgs
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		try:
+			return await self.recv()
+		except OutputStreamClosed:
+			raise StopAsyncIteration
+
+	async def close(self):
+		self._closed = True
+		if self.stream is not None:
+			await self.stream.close()
+
+	def _deliver(self, msg):
+		key = _message_key(msg._json)
+		if key in self._recent_keys:
+			return False
+		self._recent.append(key)
+		self._recent_keys.add(key)
+		if len(self._recent) > DEDUPE_WINDOW:
+			self._recent_keys.discard(self._recent.popleft())
+		if self._last is None or msg.received_ms > self._last:
+			self._last = msg.received_ms
+		return True
+
+	async def _reconnect(self):
+		import asyncio
+		import websockets
+
+		attempt = 0
+		while not self._closed:
+			try:
+				stream = await self._connect()
+			except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as err:
+				# Client errors such as a revoked token will not go away.
+				if 400 <= getattr(err, 'status_code', 500) < 500:
+					raise
+			else:
+				try:
+					missed = [] if self._last is None else await self._history(self._last)
+				except self._history_errors as err:
+					await stream.close()
+					if 400 <= getattr(err, 'http_status_code', 500) < 500:
+						raise
+				else:
+					self.stream = stream
+					self.reconnects += 1
+					missed.sort(key=lambda m: m.received_ms)
+					self._backlog.extend(m for m in missed if self._deliver(m))
+					return
+			delay = min(self.max_backoff, RECONNECT_BACKOFF * 2 ** attempt)
+			await asyncio.sleep(random.uniform(0, delay))
+			attempt += 1
+
+
 class OutputDataMessage:
-	def __init__(self, json):
-		self.device = Device(json=json['device'])
-		self.payload = base64.b64decode(json['payload'])
-		self.received = datetime.utcfromtimestamp(json['received']/1000)
+	"""A message received from a device.  When constructed from JSON the device,
+	payload and timestamp are decoded on first access."""
+	__slots__ = ('_json', '_device', '_payload', '_received')
+
+	def __init__(self, json=None, device=None, payload=None, received=None):
+		self._json = json
+		self._device = device
+		self._payload = payload
+		self._received = received
+
+	@property
+	def device(self):
+		if self._device is None:
+			self._device = Device(json=self._json['device'])
+		return self._device
+
+	@property
+	def device_id(self):
+		if self._device is None:
+			return self._json['device']['deviceId']
+		return self._device.id
+
+	@property
+	def payload(self):
+		if self._payload is None:
+			self._payload = base64.b64decode(self._json['payload'])
+		return self._payload
+
+	@property
+	def received(self):
+		if self._received is None:
+			self._received = datetime.utcfromtimestamp(self._json['received']/1000)
+		return self._received
+
+	@property
+	def received_ms(self):
+		"""The receive timestamp in milliseconds since the epoch."""
+		if self._json is not None:
+			return self._json['received']
+		return (self._received - EPOCH) // MILLISECOND
+
+class OutputDataBatch:
+	"""A column-wise container for many messages.  Timestamps are kept in an
+	int64 array, payloads in a single buffer indexed by an offset array and
+	devices as an index into the list of distinct devices."""
+	__slots__ = ('received', 'payloads', 'offsets', 'device_index', 'devices', '_device_ids')
+
+	def __init__(self, messages=()):
+		self.received = array('q')
+		self.payloads = bytearray()
+		self.offsets = array('q', [0])
+		self.device_index = array('l')
+		self.devices = []
+		self._device_ids = {}
+		self.extend(messages)
+
+	def append(self, msg):
+		i = self._device_ids.get(msg.device_id)
+		if i is None:
+			i = len(self.devices)
+			self._device_ids[msg.device_id] = i
+			self.devices.append(msg.device)
+		self.device_index.append(i)
+		self.received.append(msg.received_ms)
+		self.payloads += msg.payload
+		self.offsets.append(len(self.payloads))
+
+	def extend(self, messages):
+		for msg in messages:
+			self.append(msg)
+
+	def payload(self, i):
+		"""Return a memoryview of the i'th payload without copying it."""
+		return memoryview(self.payloads)[self.offsets[i]:self.offsets[i+1]]
+
+	def clear(self):
+		del self.received[:]
+		del self.payloads[:]
+		del self.offsets[1:]
+		del self.device_index[:]
+		self.devices.clear()
+		self._device_ids.clear()
+
+	def __len__(self):
+		return len(self.received)
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		return OutputDataMessage(
+			device=self.devices[self.device_index[i]],
+			payload=bytes(self.payload(i)),
+			received=EPOCH + self.received[i] * MILLISECOND,
+		)
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
 
 class DownstreamMessage:
+	__slots__ = ('port', 'payload')
 	def __init__(self, port, payload):
 		if not isinstance(payload, bytes):
 			raise TypeError('payload must be bytes')
@@ -610,12 +1806,64 @@ class DownstreamMessage:
 		}
 
 class BroadcastResult:
+	__slots__ = ('sent', 'failed', 'errors')
 	def __init__(self, json):
 		self.sent = json['sent']
 		self.failed = json['failed']
 		self.errors = [BroadcastError(e) for e in json['errors']]
 
+class SendManyResult:
+	"""The outcome of Client.send_many.  sent and failed are counts as in
+	BroadcastResult, sent_to the IDs of the devices the message was sent to and
+	errors a SendError for each device it was not."""
+	__slots__ = ('sent', 'failed', 'sent_to', 'errors')
+
+	def __init__(self, sent_to, errors):
+		self.sent = len(sent_to)
+		self.failed = len(errors)
+		self.sent_to = sent_to
+		self.errors = errors
+
+	def unreachable(self):
+		"""The IDs of the devices that failed because they were not reachable."""
+		return [e.device_id for e in self.errors if e.unreachable]
+
+class SendError:
+	"""Why a message could not be sent to device_id.  http_status_code is None
+	when the request failed before the server answered."""
+	__slots__ = ('device_id', 'message', 'http_status_code', 'error')
+
+	def __init__(self, device_id, error):
+		self.device_id = device_id
+		self.error = error
+		self.http_status_code = getattr(error, 'http_status_code', None)
+		self.message = error.message if isinstance(error, ClientError) else str(error)
+
+	@property
+	def unreachable(self):
+		"""The server answers 409 Conflict for devices that are not online."""
+		return self.http_status_code == 409
+
+class BulkResult:
+	"""The outcome of a bulk operation.  succeeded holds the results of the
+	items that went through, failed the items that did not and errors a
+	BulkError for each failed item, all in the order the items were given."""
+	__slots__ = ('succeeded', 'failed', 'errors')
+
+	def __init__(self):
+		self.succeeded = []
+		self.failed = []
+		self.errors = []
+
+class BulkError:
+	__slots__ = ('item', 'error')
+
+	def __init__(self, item, error):
+		self.item = item
+		self.error = error
+
 class BroadcastError:
+	__slots__ = ('device_id', 'message')
 	def __init__(self, json):
 		self.device_id = json['deviceId']
 		self.message = json['message']
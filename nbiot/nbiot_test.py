@@ -1,10 +1,17 @@
 import asyncio
+import base64
+from datetime import datetime, timedelta, timezone
 import random
 import requests
 import os
 import pytest
+import subprocess
+import sys
+import threading
 
 from nbiot import nbiot
+from nbiot import fakeserver
+from nbiot.fakeserver import FakeServer
 
 def test_config():
 	addr, token = nbiot.addressTokenFromConfig(nbiot.CONFIG_FILE)
@@ -14,6 +21,59 @@ def test_config():
 def test_client():
 	nbiot.Client()
 
+def test_lazy_client():
+	client = nbiot.Client(addr='http://127.0.0.1:1', token='', retries=0, lazy=True)
+	with pytest.raises(requests.exceptions.ConnectionError):
+		client.ping()
+
+# Importing the client must not pull in the HTTP, websocket and asyncio
+# machinery, and must stay within this many seconds.  The import is timed
+# in fresh interpreters after a first one has written the bytecode, and
+# the fastest of IMPORT_TIME_RUNS counts so that a busy machine does not
+# fail the test.
+IMPORT_TIME_BUDGET = 0.1
+IMPORT_TIME_RUNS = 3
+
+def test_import_time():
+	code = 'import sys, time; t = time.perf_counter(); import nbiot.nbiot; print(time.perf_counter() - t); print(*sorted(sys.modules))'
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	runs = [
+		subprocess.run([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE, check=True).stdout.decode().split('\n')
+		for _ in range(1 + IMPORT_TIME_RUNS)
+	]
+	assert min(float(out[0]) for out in runs[1:]) < IMPORT_TIME_BUDGET
+	out = runs[0]
+	modules = out[1].split()
+	for m in ['requests', 'websockets', 'asyncio', 'concurrent.futures']:
+		assert m not in modules
+
+@pytest.mark.parametrize('codec', ['json', 'orjson'])
+def test_codec(codec):
+	if codec == 'orjson':
+		pytest.importorskip('orjson')
+		codec = nbiot.OrjsonCodec()
+	else:
+		codec = nbiot.JSONCodec()
+	models = [
+		nbiot.Team(members=[nbiot.Member(role='admin')]),
+		nbiot.Collection(field_mask=nbiot.FieldMask(imsi=True)),
+		nbiot.Device(imsi='12', imei='34'),
+		nbiot.WebHookOutput(url=nbiot.DEFAULT_ADDRESS),
+		nbiot.MQTTOutput(endpoint='mqtt://example.com'),
+		nbiot.IFTTTOutput(key='key'),
+		nbiot.UDPOutput(host='example.com', port=1234),
+		nbiot.DownstreamMessage(1234, b'hello'),
+	]
+	for m in models:
+		assert codec.loads(codec.dumps(m.json())) == m.json()
+
+	client = nbiot.Client(codec=codec)
+	collection = client.create_collection(nbiot.Collection(tags={'codec': 'test'}))
+	try:
+		assert client.collection(collection.id).tags == {'codec': 'test'}
+	finally:
+		client.delete_collection(collection.id)
+
 def test_system_defaults():
 	nbiot.Client().system_defaults()
 
@@ -133,6 +193,247 @@ async def test_output_stream():
 	finally:
 		client.delete_collection(collection.id)
 
+def test_data(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		devices = [client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid())) for i in range(3)]
+		start = 1546300800000
+		for i in range(30):
+			server.inject(collection.id, devices[i % 3].id, bytes([i]), received=start + i // 2)
+
+		assert len(client.collection_data(collection.id, limit=5)) == 5
+		msgs = list(client.iter_collection_data(collection.id, page_size=7))
+		assert [m.payload for m in msgs] == [bytes([i]) for i in reversed(range(30))]
+		msgs = list(client.iter_device_data(collection.id, devices[0].id, page_size=4))
+		assert len(msgs) == 10
+
+		since = datetime.fromtimestamp(start / 1000, timezone.utc)
+		until = since + timedelta(milliseconds=15)
+		msgs = list(client.backfill(collection.id, since, until, shard=timedelta(milliseconds=4), per_device=True, workers=3))
+		assert sorted(m.payload for m in msgs) == [bytes([i]) for i in range(30)]
+		assert all(a.received_ms <= b.received_ms for a, b in zip(msgs, msgs[1:]))
+	finally:
+		client.delete_collection(collection.id)
+
+def test_backfill_per_device(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		# More devices than the shards that fit in memory at once.
+		workers = 2
+		devices = [client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid())) for i in range(2 * workers + 3)]
+		start = 1546300800000
+		for i in range(60):
+			server.inject(collection.id, devices[i % len(devices)].id, bytes([i]), received=start + i)
+
+		since = datetime.fromtimestamp(start / 1000, timezone.utc)
+		until = since + timedelta(milliseconds=60)
+		for shard in [timedelta(milliseconds=7), timedelta(milliseconds=100)]:
+			msgs = list(client.backfill(collection.id, since, until, shard=shard, per_device=True, workers=workers))
+			assert [m.payload for m in msgs] == [bytes([i]) for i in range(60)]
+	finally:
+		client.delete_collection(collection.id)
+
+def test_data_paging(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		device = client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid()))
+		start = 1546300800000
+		# Bursts within one millisecond, including identical messages.
+		for ms, payload in [(0, b'a'), (1, b'b'), (1, b'c'), (1, b'c'), (2, b'd'), (2, b'd'), (2, b'e')]:
+			server.inject(collection.id, device.id, payload, received=start + ms)
+		for page_size in [1, 2, 3, 100]:
+			msgs = list(client.iter_collection_data(collection.id, page_size=page_size))
+			assert sorted(m.payload for m in msgs) == [b'a', b'b', b'c', b'c', b'd', b'd', b'e'], page_size
+			assert [m.received_ms - start for m in msgs] == [2, 2, 2, 1, 1, 1, 0]
+	finally:
+		client.delete_collection(collection.id)
+
+def test_data_paging_capped(server, monkeypatch):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	# The server returns fewer messages than asked for.
+	monkeypatch.setattr(fakeserver, 'MAX_LIMIT', 10)
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		device = client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid()))
+		start = 1546300800000
+		for i in range(17):
+			server.inject(collection.id, device.id, bytes([i]), received=start + i)
+		for i in range(8):
+			server.inject(collection.id, device.id, bytes([100 + i]), received=start + 5)
+		expected = sorted([bytes([i]) for i in range(17)] + [bytes([100 + i]) for i in range(8)])
+		for page_size in [3, 20]:
+			msgs = list(client.iter_collection_data(collection.id, page_size=page_size))
+			assert sorted(m.payload for m in msgs) == expected, page_size
+	finally:
+		client.delete_collection(collection.id)
+
+def test_bulk_devices():
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		devices = [nbiot.Device(imsi=randid(), imei=randid()) for i in range(20)]
+		devices[3].imsi = devices[2].imsi
+		res = client.create_devices(collection.id, devices, workers=4)
+		assert len(res.succeeded) == 19
+		assert len(res.failed) == 1 and res.failed[0] in devices[2:4]
+		assert res.errors[0].error.http_status_code == requests.codes.conflict
+
+		res = client.delete_devices(collection.id, [d.id for d in res.succeeded] + ['0'], workers=4)
+		assert len(res.succeeded) == 19
+		assert res.failed == ['0']
+		assert len(client.devices(collection.id)) == 0
+	finally:
+		client.delete_collection(collection.id)
+
+def test_cache():
+	cache = nbiot.Cache(ttl=60)
+	client = nbiot.Client(cache=cache)
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		device = client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid()))
+		for i in range(3):
+			assert client.device(collection.id, device.id).tags == {}
+		assert (cache.hits, cache.misses) == (2, 1)
+
+		device.tags['test_key'] = 'test_value'
+		client.update_device(collection.id, device)
+		assert client.device(collection.id, device.id).tags == device.tags
+		assert cache.misses == 2
+	finally:
+		client.delete_collection(collection.id)
+
+def test_cache_invalidate():
+	cache = nbiot.Cache(maxsize=6)
+	paths = ['/collections', '/collections/1', '/collections/1/devices', '/collections/1/devices/2', '/collections/1/devices/3', '/collections/10']
+	for path in paths:
+		cache.put(path, b'', None, 0)
+	cache.invalidate('/collections/1/devices/2')
+	assert list(cache._entries) == ['/collections/1/devices/3', '/collections/10']
+	cache.invalidate('/collections/1')
+	assert list(cache._entries) == ['/collections/10']
+	cache.put('/teams', b'', None, cache.get('/teams')[1])
+	cache.invalidate('/collections/10')
+	assert list(cache._entries) == ['/teams']
+	assert cache._paths == {'/teams': {'/teams'}} and cache._subtrees == {'/teams': {'/teams'}}
+
+def test_send_many(server):
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		devices = [client.create_device(collection.id, nbiot.Device(imsi=randid(), imei=randid())) for i in range(5)]
+		messages = [(d.id, nbiot.DownstreamMessage(1234, bytes([i]))) for i, d in enumerate(devices)]
+		res = client.send_many(collection.id, messages + [('0', nbiot.DownstreamMessage(1234, b''))], workers=3)
+		assert (res.sent, res.failed) == (0, 6)
+		assert res.unreachable() == [d.id for d in devices]
+		assert res.errors[-1].device_id == '0'
+		assert res.errors[-1].http_status_code == requests.codes.not_found
+		assert not res.errors[-1].unreachable
+
+		if server is None:
+			return
+		server.reachable = True
+		try:
+			res = client.send_many(collection.id, messages, workers=3)
+		finally:
+			server.reachable = False
+		assert (res.sent, res.failed) == (5, 0)
+		assert res.sent_to == [d.id for d in devices]
+		assert sorted(server.downstream[-5:]) == sorted((d.id, 1234, bytes([i])) for i, d in enumerate(devices))
+	finally:
+		client.delete_collection(collection.id)
+
+def test_rate_limiter(server):
+	limiter = nbiot.RateLimiter(rate=1000, burst=1, rates={'POST': (10, 2)})
+	start = nbiot.time.monotonic()
+	assert [limiter.reserve('POST', '/collections') for i in range(3)] == [0, 0, pytest.approx(0.1, abs=1e-3)]
+	assert limiter.reserve('GET', '/collections') == 0
+	assert limiter.reserve('GET', '/collections') == pytest.approx(0.001, abs=1e-3)
+
+	limiter.throttled('POST', '/collections', 5)
+	assert limiter.rate('POST', '/collections') == 5
+	assert limiter.reserve('POST', '/collections') >= 4.9 - (nbiot.time.monotonic() - start)
+	assert limiter.rate('GET', '/teams') == 1000
+
+	assert nbiot._retry_after('2') == 2
+	assert nbiot._retry_after('Thu, 01 Jan 1970 00:00:00 GMT') == 0
+	assert nbiot._retry_after('soon') is None
+
+	if server is None:
+		pytest.skip('needs the fake server to throttle requests')
+	limiter = nbiot.RateLimiter(rate=100)
+	client = nbiot.Client(rate_limiter=limiter)
+	server.throttle(1, retry_after=1)
+	start = nbiot.time.monotonic()
+	client.collections()
+	assert nbiot.time.monotonic() - start >= 1
+	assert limiter.rate('GET', '/collections') < 100
+
+	server.throttle(1)
+	with pytest.raises(nbiot.ClientError) as err:
+		client.create_collection(nbiot.Collection())
+	assert err.value.http_status_code == 429
+	assert err.value.retry_after == 0
+
+# The stress test runs this many threads sharing one client.
+STRESS_THREADS = 64
+
+def test_threads():
+	with FakeServer() as server:
+		inst = Counting()
+		cache = nbiot.Cache(maxsize=32)
+		limiter = nbiot.RateLimiter(rate=100000)
+		client = nbiot.Client(addr=server.addr, token=server.token, pool_size=16, cache=cache, instrumentation=inst, rate_limiter=limiter)
+		collection = client.create_collection(nbiot.Collection())
+		barrier = threading.Barrier(STRESS_THREADS)
+		errors = []
+
+		def work(n):
+			try:
+				barrier.wait()
+				device = client.create_device(collection.id, nbiot.Device(imsi='imsi{0}'.format(n), imei='imei{0}'.format(n)))
+				for i in range(5):
+					device.tags['i'] = '{0}.{1}'.format(n, i)
+					client.update_device(collection.id, device)
+					assert client.device(collection.id, device.id).tags == device.tags
+					assert client.device(collection.id, device.id).imsi == device.imsi
+					client.collection(collection.id)
+				client.delete_device(collection.id, device.id)
+			except Exception as err:
+				errors.append(err)
+
+		threads = [threading.Thread(target=work, args=(n,)) for n in range(STRESS_THREADS)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		assert errors == []
+		assert client.devices(collection.id) == []
+		assert len(cache) <= cache.maxsize
+		assert inst.requests == server.requests - server.throttled + cache.hits
+		# Every connection is reused rather than opened per request.
+		assert server.connections <= 16
+		client.delete_collection(collection.id)
+		client.close()
+
+class Counting(nbiot.Instrumentation):
+	def __init__(self):
+		self.requests = 0
+		self.lock = threading.Lock()
+	def on_request(self, event):
+		with self.lock:
+			self.requests += 1
+
 @pytest.mark.skipif(os.environ.get('CI') != 'true', reason='downstream tests are slow')
 def test_downstream():
 	client = nbiot.Client()
@@ -150,8 +451,171 @@ def test_downstream():
 		[client.delete_device(collection.id, d.id) for d in devices]
 		client.delete_collection(collection.id)
 
+def test_output_data_batch():
+	msgs = [data_message(str(i % 3), bytes([i] * i), 1546300800000 + i) for i in range(10)]
+	batch = nbiot.OutputDataBatch(msgs)
+	assert len(batch) == len(msgs)
+	assert len(batch.devices) == 3
+	for a, b in zip(batch, msgs):
+		assert a.device.id == b.device.id
+		assert a.payload == b.payload
+		assert a.received == b.received
+		assert a.received_ms == b.received_ms
+
+@pytest.mark.asyncio
+async def test_resilient_output_stream():
+	msgs = [data_message(str(i % 2), bytes([i]), 1546300800000 + i) for i in range(6)]
+
+	class Stream:
+		def __init__(self, msgs):
+			self.msgs = list(msgs)
+		async def recv(self):
+			if not self.msgs:
+				raise nbiot.OutputStreamClosed()
+			return self.msgs.pop(0)
+		async def recv_many(self, max_n, timeout=None):
+			if not self.msgs:
+				raise nbiot.OutputStreamClosed()
+			batch, self.msgs = self.msgs[:max_n], self.msgs[max_n:]
+			return batch
+		async def close(self):
+			pass
+
+	# The first connection drops after two messages, the second one resumes
+	# with an overlap and history fills in the gap.
+	streams = [Stream(msgs[4:])]
+	async def connect():
+		return streams.pop(0)
+	async def history(since):
+		assert since == msgs[1].received_ms
+		return [m for m in msgs if m.received_ms >= since]
+
+	stream = nbiot.ResilientOutputStream(Stream(msgs[:2]), connect, history, ())
+	got = [await stream.recv() for _ in msgs]
+	assert [m.received_ms for m in got] == [m.received_ms for m in msgs]
+	assert stream.reconnects == 1
+	await stream.close()
+	with pytest.raises(nbiot.OutputStreamClosed):
+		await stream.recv()
+	assert [m async for m in stream] == []
+
+	streams = [Stream(msgs[4:])]
+	stream = nbiot.ResilientOutputStream(Stream(msgs[:2]), connect, history, ())
+	assert len(await stream.recv_many(10)) == 2
+	got = await stream.recv_many(10)
+	assert [m.received_ms for m in got] == [m.received_ms for m in msgs[2:]]
+
+@pytest.mark.asyncio
+async def test_output_stream_batches():
+	with FakeServer(keepalive=0.05) as server:
+		client = nbiot.Client(addr=server.addr, token=server.token)
+		collection = client.create_collection(nbiot.Collection())
+		device = client.create_device(collection.id, nbiot.Device(imsi='batch', imei='batch'))
+		frames = []
+		stream = await client.collection_output_stream(collection.id, on_frame=frames.append)
+		# recv_many needs the frame queue of the legacy websockets protocol.
+		with pytest.raises(TypeError):
+			nbiot.OutputStream(object())
+		assert await stream.recv_many(timeout=0.01) == []
+
+		for i in range(30):
+			server.inject(collection.id, device.id, bytes([i]))
+		msgs = await stream.recv_many(10, timeout=1)
+		while len(msgs) < 30:
+			msgs += await stream.recv_many(30 - len(msgs))
+		assert [m.payload for m in msgs] == [bytes([i]) for i in range(30)]
+
+		# Keepalives are passed on as they are read.
+		assert await stream.recv_many(timeout=0.2) == []
+		assert frames[0] == {'type': 'KeepAlive'}
+
+		server.inject(collection.id, device.id, b'last')
+		async for msg in stream:
+			assert msg.payload == b'last'
+			server.drop_streams()
+		with pytest.raises(nbiot.OutputStreamClosed):
+			await stream.recv_many()
+		client.close()
+
+@pytest.mark.asyncio
+async def test_device_registry(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		a = client.create_device(collection.id, nbiot.Device(imsi='reg-a', imei='reg-a', tags={'site': 'x'}))
+		registry = client.device_registry(collection.id)
+		assert client.device_registry(collection.id) is registry
+		device = registry.get(a.id)
+		assert registry.by_imsi('reg-a') is device and registry.by_imei('reg-a') is device
+
+		b = client.create_device(collection.id, nbiot.Device(imsi='reg-b', imei='reg-b', tags={'site': 'x'}))
+		assert {d.id for d in registry.tagged('site', 'x')} == {a.id, b.id}
+		b.tags['site'] = 'y'
+		client.update_device(collection.id, b)
+		assert [d.id for d in registry.tagged('site', 'x')] == [a.id]
+		assert [d.id for d in registry.tagged('site', 'y')] == [b.id]
+		client.delete_device_tag(collection.id, b.id, 'site')
+		assert registry.tagged('site', 'y') == [] and len(registry.tagged('site')) == 1
+		client.delete_device(collection.id, b.id)
+		assert b.id not in registry and registry.by_imsi('reg-b') is None
+
+		server.inject(collection.id, a.id, b'1')
+		# History carries the device as it was and must not roll it back.
+		a.tags['site'] = 'w'
+		client.update_device(collection.id, a)
+		assert client.collection_data(collection.id)[0].device is device
+		assert device.tags == {'site': 'w'} and registry.tagged('site', 'w') == [device]
+		# So must a stream message received before the update.
+		assert registry.intern(dict(device.json(), tags={'site': 'x'}), received=0) is device
+		assert device.tags == {'site': 'w'}
+
+		stream = await client.collection_output_stream(collection.id)
+		server.inject(collection.id, a.id, b'2')
+		assert (await stream.recv()).device is device
+		# Changes made elsewhere are picked up from the messages.
+		server.devices[a.id]['tags'] = {'site': 'z'}
+		server.inject(collection.id, a.id, b'3')
+		assert (await stream.recv()).device is device
+		assert device.tags == {'site': 'z'} and registry.tagged('site', 'z') == [device]
+		await stream.close()
+	finally:
+		client.delete_collection(collection.id)
+		client.close()
+
+def test_device_registry_threads():
+	# History is decoded in several threads at once; the first to take the
+	# lock registers the device and the others must return it.
+	json = {'deviceId': '1', 'collectionId': '1', 'imsi': '12', 'imei': '34', 'tags': {}}
+	interval = sys.getswitchinterval()
+	sys.setswitchinterval(1e-6)
+	try:
+		for _ in range(1000):
+			registry = nbiot.DeviceRegistry('1', [])
+			barrier = threading.Barrier(4)
+			results = []
+			def intern():
+				barrier.wait()
+				results.append(registry.intern(json))
+			threads = [threading.Thread(target=intern) for _ in range(4)]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			assert len(results) == 4 and all(d is registry.get('1') for d in results)
+	finally:
+		sys.setswitchinterval(interval)
+
+def data_message(device_id, payload, received):
+	return nbiot.OutputDataMessage(json={
+		'device': {'deviceId': device_id, 'collectionId': '1', 'imsi': '12', 'imei': '34'},
+		'payload': base64.b64encode(payload).decode('ascii'),
+		'received': received,
+	})
+
 def randid():
-	return str(random.randrange(1e15))
+	return str(random.randrange(10**15))
 
 def contains(X, x):
 	return any([y.id == x.id for y in X])
\ No newline at end of file
@@ -0,0 +1,191 @@
+from collections import deque
+from datetime import timedelta
+import inspect
+
+from .nbiot import DEDUPE_WINDOW, EPOCH, MILLISECOND, OutputStreamClosed, _message_key
+
+async def messages(source):
+	"""Yield the messages of a stream until it is closed."""
+	if hasattr(source, '__aiter__'):
+		async for msg in source:
+			yield msg
+		return
+	while True:
+		try:
+			msg = await source.recv()
+		except OutputStreamClosed:
+			return
+		yield msg
+
+async def select(source, predicate):
+	"""Yield the messages for which predicate(msg) is true."""
+	async for msg in messages(source):
+		if predicate(msg):
+			yield msg
+
+def devices(source, device_ids):
+	"""Yield the messages from the given devices."""
+	device_ids = set(device_ids)
+	return select(source, lambda msg: msg.device_id in device_ids)
+
+def tagged(source, name, value=None):
+	"""Yield the messages from devices that have the tag name, or that have it
+	set to value if given."""
+	if value is None:
+		return select(source, lambda msg: name in msg.device.tags)
+	return select(source, lambda msg: msg.device.tags.get(name) == value)
+
+async def transform(source, fn):
+	"""Yield fn(msg) for every message; fn may be a coroutine function."""
+	async for msg in messages(source):
+		x = fn(msg)
+		if inspect.isawaitable(x):
+			x = await x
+		yield x
+
+async def decode(source, registry):
+	"""Yield (msg, value) pairs with the payload decoded by a
+	decoders.DecoderRegistry, skipping messages no decoder applies to."""
+	async for msg in messages(source):
+		decoder = registry.decoder(msg.device)
+		if decoder is not None:
+			yield msg, decoder.decode(msg.payload)
+
+async def dedupe(source, window=DEDUPE_WINDOW):
+	"""Drop messages identical to one of the last window messages, as seen when
+	a stream is replayed or several streams overlap."""
+	recent = deque()
+	seen = set()
+	async for msg in messages(source):
+		key = _key(msg)
+		if key in seen:
+			continue
+		recent.append(key)
+		seen.add(key)
+		if len(recent) > window:
+			seen.discard(recent.popleft())
+		yield msg
+
+def _key(msg):
+	if msg._json is not None:
+		return _message_key(msg._json)
+	return (msg.device_id, msg.received_ms, msg.payload)
+
+
+def device_id(msg):
+	return msg.device_id
+
+class Window:
+	"""The aggregates of the messages with the same key received in [start, end):
+	their count and rate per second and the first and last value."""
+	__slots__ = ('key', 'start_ms', 'end_ms', 'count', 'first', 'last')
+
+	def __init__(self, key, start_ms, end_ms, count=0, first=None, last=None):
+		self.key = key
+		self.start_ms = start_ms
+		self.end_ms = end_ms
+		self.count = count
+		self.first = first
+		self.last = last
+
+	@property
+	def start(self):
+		return EPOCH + self.start_ms * MILLISECOND
+
+	@property
+	def end(self):
+		return EPOCH + self.end_ms * MILLISECOND
+
+	@property
+	def rate(self):
+		return self.count * 1000 / (self.end_ms - self.start_ms)
+
+	def _add(self, value):
+		if self.count == 0:
+			self.first = value
+		self.count += 1
+		self.last = value
+
+async def tumbling(source, size, key=device_id, value=None):
+	"""Group messages into consecutive windows of the given timedelta by their
+	receive time and yield a Window per key when the window is over.  key(msg)
+	chooses the group, device ID by default, or None for a single group;
+	value(msg) is what first and last hold, the message itself by default.
+
+	A window is over when a message from a later window arrives; the last ones
+	are yielded when the source ends.  Messages older than the current window
+	are dropped."""
+	size = _ms(size)
+	windows = {}
+	end = None
+	async for msg in messages(source):
+		t = msg.received_ms
+		if end is None or t >= end:
+			for w in windows.values():
+				yield w
+			windows = {}
+			end = t - t % size + size
+		elif t < end - size:
+			continue
+		k = key and key(msg)
+		w = windows.get(k)
+		if w is None:
+			w = windows[k] = Window(k, end - size, end)
+		w._add(msg if value is None else value(msg))
+	for w in windows.values():
+		yield w
+
+async def sliding(source, size, step, key=device_id, value=None):
+	"""Yield a Window per key over the last size of receive time every step,
+	for each key with messages in it.  size must be a multiple of step.  Each
+	key keeps one aggregate per step, so state is bounded by size/step.  key
+	and value are as for tumbling; messages older than the current step are
+	dropped."""
+	size, step = _ms(size), _ms(step)
+	if size % step:
+		raise ValueError('the window size must be a multiple of the step')
+	steps = {}
+	boundary = None
+	async for msg in messages(source):
+		t = msg.received_ms
+		if boundary is None:
+			boundary = t - t % step + step
+		while t >= boundary:
+			for w in _slide(steps, boundary - size, boundary):
+				yield w
+			boundary += step
+			if not steps:
+				# Skip the steps in a gap in the stream.
+				boundary = t - t % step + step
+		if t < boundary - step:
+			continue
+		k = key and key(msg)
+		buckets = steps.get(k)
+		if buckets is None:
+			buckets = steps[k] = deque()
+		if not buckets or buckets[-1].start_ms != boundary - step:
+			buckets.append(Window(k, boundary - step, boundary))
+		buckets[-1]._add(msg if value is None else value(msg))
+	# The windows ending with the last step are yielded when the source ends.
+	if boundary is not None:
+		for w in _slide(steps, boundary - size, boundary):
+			yield w
+
+def _slide(steps, start, end):
+	windows = []
+	for k, buckets in list(steps.items()):
+		while buckets and buckets[0].start_ms < start:
+			buckets.popleft()
+		if not buckets:
+			del steps[k]
+			continue
+		windows.append(_merge(k, start, end, buckets))
+	return windows
+
+def _merge(key, start, end, buckets):
+	return Window(key, start, end, sum(b.count for b in buckets), buckets[0].first, buckets[-1].last)
+
+def _ms(t):
+	if isinstance(t, timedelta):
+		return int(t.total_seconds() * 1000)
+	return int(t)
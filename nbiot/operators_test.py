@@ -0,0 +1,71 @@
+import pytest
+
+from nbiot import nbiot
+from nbiot import operators
+from nbiot.nbiot_test import data_message
+
+class Stream:
+	def __init__(self, msgs):
+		self.msgs = list(msgs)
+
+	async def recv(self):
+		if not self.msgs:
+			raise nbiot.OutputStreamClosed()
+		return self.msgs.pop(0)
+
+async def collect(source):
+	return [x async for x in source]
+
+def summary(windows):
+	return [(w.key, w.start_ms, w.end_ms, w.count, w.first.payload, w.last.payload) for w in windows]
+
+@pytest.mark.asyncio
+async def test_filters():
+	msgs = [data_message(str(i % 3), bytes([i]), i) for i in range(9)]
+	out = await collect(operators.devices(Stream(msgs), ['0', '2']))
+	assert [m.payload for m in out] == [bytes([i]) for i in range(9) if i % 3 != 1]
+
+	out = await collect(operators.select(Stream(msgs), lambda m: m.payload[0] > 6))
+	assert len(out) == 2
+
+	tagged = nbiot.OutputDataMessage(device=nbiot.Device(id='9', tags={'type': 'meter'}), payload=b'', received=nbiot.EPOCH)
+	out = await collect(operators.tagged(Stream(msgs + [tagged]), 'type', 'meter'))
+	assert out == [tagged]
+
+	async def payload(m):
+		return m.payload
+	out = await collect(operators.transform(operators.dedupe(Stream(msgs + msgs[6:] + msgs[:1]), window=4), payload))
+	assert out == [bytes([i]) for i in range(9)] + [bytes([0])]
+
+@pytest.mark.asyncio
+async def test_tumbling():
+	msgs = [data_message(str(i % 2), bytes([i]), 1000 + i * 100) for i in range(25)] + [data_message('0', b'late', 1000)]
+	windows = await collect(operators.tumbling(Stream(msgs), 1000))
+	assert summary(windows) == [
+		('0', 1000, 2000, 5, bytes([0]), bytes([8])),
+		('1', 1000, 2000, 5, bytes([1]), bytes([9])),
+		('0', 2000, 3000, 5, bytes([10]), bytes([18])),
+		('1', 2000, 3000, 5, bytes([11]), bytes([19])),
+		('0', 3000, 4000, 3, bytes([20]), bytes([24])),
+		('1', 3000, 4000, 2, bytes([21]), bytes([23])),
+	]
+	assert windows[0].rate == 5
+
+	windows = await collect(operators.tumbling(Stream(msgs), 2000, key=None, value=lambda m: m.payload[0]))
+	assert [(w.key, w.count, w.first, w.last) for w in windows] == [(None, 10, 0, 9), (None, 15, 10, 24)]
+
+@pytest.mark.asyncio
+async def test_sliding():
+	times = [0, 100, 600, 1200, 1300, 5100]
+	msgs = [data_message('0', bytes([i]), t) for i, t in enumerate(times)]
+	windows = await collect(operators.sliding(Stream(msgs), 1000, 500))
+	assert summary(windows) == [
+		('0', -500, 500, 2, bytes([0]), bytes([1])),
+		('0', 0, 1000, 3, bytes([0]), bytes([2])),
+		('0', 500, 1500, 3, bytes([2]), bytes([4])),
+		('0', 1000, 2000, 2, bytes([3]), bytes([4])),
+		('0', 4500, 5500, 1, bytes([5]), bytes([5])),
+	]
+	assert await collect(operators.sliding(Stream([]), 1000, 500)) == []
+	with pytest.raises(ValueError):
+		await collect(operators.sliding(Stream(msgs), 1000, 300))
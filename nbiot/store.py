@@ -0,0 +1,177 @@
+import base64
+import itertools
+import json
+import sqlite3
+import threading
+
+from .nbiot import (
+	DEFAULT_PAGE_SIZE,
+	EPOCH,
+	MILLISECOND,
+	Device,
+	OutputDataMessage,
+	OutputStreamClosed,
+	_timestamp,
+)
+
+# Messages received from a stream are committed in transactions of this many.
+# Anything not yet committed is fetched again by the next sync.
+DEFAULT_COMMIT_SIZE = 100
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+	collection_id TEXT NOT NULL,
+	device_id TEXT NOT NULL,
+	received INTEGER NOT NULL,
+	payload BLOB NOT NULL,
+	UNIQUE (device_id, received, payload)
+);
+CREATE INDEX IF NOT EXISTS messages_device ON messages (collection_id, device_id, received);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (collection_id, received);
+CREATE TABLE IF NOT EXISTS devices (
+	device_id TEXT PRIMARY KEY,
+	device TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+	collection_id TEXT PRIMARY KEY,
+	received INTEGER NOT NULL
+);
+'''
+
+class MessageStore:
+	"""A local SQLite copy of the message history of collections, indexed by
+	device and receive time.  sync fetches the messages received since the
+	last sync (the collection's watermark) from client, and follow records
+	the messages of a live output stream.  collection_data and device_data
+	then answer range queries without touching the API.
+
+	path is an SQLite database file, created if needed; the default keeps
+	the store in memory.  The store can be shared between threads."""
+	def __init__(self, client, path=':memory:'):
+		self.client = client
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.executescript(_SCHEMA)
+		self._lock = threading.Lock()
+		self._devices = {}
+
+	def close(self):
+		self._db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def watermark(self, collection_id):
+		"""The receive time in milliseconds of the newest message stored for a
+		collection, or None."""
+		with self._lock:
+			row = self._db.execute('SELECT received FROM watermarks WHERE collection_id = ?', (collection_id,)).fetchone()
+		return row and row[0]
+
+	def sync(self, collection_id, since=None, page_size=DEFAULT_PAGE_SIZE):
+		"""Fetch and store the messages received by a collection since its
+		watermark, or since the given datetime on the first sync.  Returns the
+		number of new messages."""
+		start = self.watermark(collection_id)
+		if start is None:
+			start = _timestamp(since)
+		messages = iter(self.client._iter_data_json('/collections/{0}'.format(collection_id), start, 0, page_size))
+		added = 0
+		newest = None
+		while True:
+			page = [(m['device'], m['received'], base64.b64decode(m['payload'])) for m in itertools.islice(messages, page_size)]
+			if not page:
+				break
+			# The watermark message is fetched again since the range is
+			# inclusive, but it and any others already stored are ignored.
+			with self._lock, self._db:
+				n, received = self._insert(collection_id, page)
+			added += n
+			if newest is None or received > newest:
+				newest = received
+		# The watermark only moves once the whole range is stored, so an
+		# interrupted sync starts over from the old one.
+		self._store(collection_id, [], newest)
+		return added
+
+	async def follow(self, collection_id, stream, commit_size=DEFAULT_COMMIT_SIZE, since=None):
+		"""Store the messages of an output stream of the collection until the
+		stream is closed.  The stream must already be connected: follow first
+		syncs, with since as for sync, so that messages received before the
+		stream connected are stored before the watermark moves past them."""
+		import asyncio
+
+		await asyncio.get_event_loop().run_in_executor(None, self.sync, collection_id, since)
+		pending = []
+		try:
+			while True:
+				try:
+					msg = await stream.recv()
+				except OutputStreamClosed:
+					return
+				pending.append((msg.device.json(), msg.received_ms, msg.payload))
+				if len(pending) >= commit_size:
+					self._store(collection_id, pending)
+					pending = []
+		finally:
+			if pending:
+				self._store(collection_id, pending)
+
+	def _store(self, collection_id, rows, newest=None):
+		with self._lock, self._db:
+			_, received = self._insert(collection_id, rows)
+			if newest is None or (received is not None and received > newest):
+				newest = received
+			if newest is not None:
+				# Not an upsert, which needs SQLite 3.24.
+				self._db.execute('INSERT OR IGNORE INTO watermarks VALUES (?, ?)', (collection_id, newest))
+				self._db.execute('UPDATE watermarks SET received = max(received, ?) WHERE collection_id = ?', (newest, collection_id))
+
+	def _insert(self, collection_id, rows):
+		newest = None
+		values = []
+		for device, received, payload in rows:
+			device_id = device['deviceId']
+			if self._devices.get(device_id) != device:
+				self._devices[device_id] = device
+				self._db.execute('INSERT OR REPLACE INTO devices VALUES (?, ?)', (device_id, json.dumps(device)))
+			if newest is None or received > newest:
+				newest = received
+			values.append((collection_id, device_id, received, payload))
+		cur = self._db.executemany('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?)', values)
+		return cur.rowcount, newest
+
+	def collection_data(self, collection_id, since=None, until=None, limit=None):
+		"""The stored messages of a collection received between since
+		(inclusive) and until (exclusive), newest first."""
+		return self._query('collection_id = ?', (collection_id,), since, until, limit)
+
+	def device_data(self, collection_id, device_id, since=None, until=None, limit=None):
+		"""The stored messages of a device received between since (inclusive)
+		and until (exclusive), newest first."""
+		return self._query('collection_id = ? AND device_id = ?', (collection_id, device_id), since, until, limit)
+
+	def _query(self, where, args, since, until, limit):
+		since, until = _timestamp(since), _timestamp(until)
+		if since:
+			where += ' AND received >= ?'
+			args += (since,)
+		if until:
+			where += ' AND received < ?'
+			args += (until,)
+		sql = 'SELECT device_id, received, payload FROM messages WHERE {0} ORDER BY received DESC'.format(where)
+		if limit:
+			sql += ' LIMIT {0:d}'.format(limit)
+		with self._lock:
+			rows = self._db.execute(sql, args).fetchall()
+			devices = {}
+			for device_id, _, _ in rows:
+				if device_id not in devices:
+					devices[device_id] = self._device(device_id)
+		return [OutputDataMessage(device=devices[d], payload=p, received=EPOCH + r * MILLISECOND) for d, r, p in rows]
+
+	def _device(self, device_id):
+		row = self._db.execute('SELECT device FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+		return Device(json=json.loads(row[0]))
@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime, timezone
+import pytest
+
+from nbiot import nbiot
+from nbiot import store
+
+START = 1546300800000
+
+def test_sync(server, tmp_path):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		devices = [client.create_device(collection.id, nbiot.Device(imsi='store{0}'.format(i), imei='store')) for i in range(2)]
+		for i in range(20):
+			server.inject(collection.id, devices[i % 2].id, bytes([i]), received=START + i)
+
+		path = tmp_path / 'store.db'
+		with store.MessageStore(client, path) as s:
+			assert s.sync(collection.id, page_size=6) == 20
+			assert s.watermark(collection.id) == START + 19
+			for i in range(20, 25):
+				server.inject(collection.id, devices[i % 2].id, bytes([i]), received=START + i)
+			requests = server.requests
+			assert s.sync(collection.id, page_size=6) == 5
+			assert server.requests - requests == 2
+
+		requests = server.requests
+		with store.MessageStore(client, path) as s:
+			msgs = s.collection_data(collection.id)
+			assert [m.payload for m in msgs] == [bytes([i]) for i in reversed(range(25))]
+			since = datetime.fromtimestamp((START + 10) / 1000, timezone.utc)
+			until = datetime.fromtimestamp((START + 20) / 1000, timezone.utc)
+			msgs = s.device_data(collection.id, devices[1].id, since, until, limit=3)
+			assert [m.payload for m in msgs] == [bytes([19]), bytes([17]), bytes([15])]
+			assert msgs[0].device.imsi == 'store1'
+			assert msgs[0].received_ms == START + 19
+		assert server.requests == requests
+	finally:
+		client.delete_collection(collection.id)
+
+@pytest.mark.asyncio
+async def test_follow(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		device = client.create_device(collection.id, nbiot.Device(imsi='follow', imei='follow'))
+		with store.MessageStore(client) as s:
+			stream = await client.collection_output_stream(collection.id)
+			task = asyncio.create_task(s.follow(collection.id, stream, commit_size=2))
+			for i in range(5):
+				server.inject(collection.id, device.id, bytes([i]), received=START + i)
+			while len(s.collection_data(collection.id)) < 4:
+				await asyncio.sleep(0.01)
+			await stream.close()
+			await task
+			assert [m.payload for m in s.collection_data(collection.id)] == [bytes([i]) for i in reversed(range(5))]
+			assert s.watermark(collection.id) == START + 4
+			assert s.sync(collection.id) == 0
+
+			# A message received between a sync and the stream connecting is
+			# stored by follow rather than skipped.
+			server.inject(collection.id, device.id, b'gap', received=START + 5)
+			stream = await client.collection_output_stream(collection.id)
+			task = asyncio.create_task(s.follow(collection.id, stream))
+			server.inject(collection.id, device.id, b'live', received=START + 6)
+			while len(s.collection_data(collection.id)) < 7:
+				await asyncio.sleep(0.01)
+			await stream.close()
+			await task
+			assert [m.payload for m in s.collection_data(collection.id, limit=2)] == [b'live', b'gap']
+			assert s.sync(collection.id) == 0
+	finally:
+		client.delete_collection(collection.id)
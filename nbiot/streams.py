@@ -0,0 +1,298 @@
+import asyncio
+from collections import deque
+import threading
+
+from .nbiot import DEFAULT_BATCH_SIZE, OutputStreamClosed
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+DEFAULT_QUEUE_SIZE = 10000
+
+class StreamManager:
+	"""Multiplex the output streams of many collections and devices into one
+	bounded queue.  client is an nbiot.Client or nbiot.aio.AsyncClient.
+
+	When the queue is full the policy decides what happens: BLOCK stops reading
+	from the websockets until there is room, DROP_OLDEST discards the oldest
+	queued message and DROP_NEWEST discards the incoming one.  Subscriptions
+	can be added and removed while the manager is running.
+
+	If a stream fails with an error other than being closed, the error is
+	recorded on its subscription and raised by recv once the queue is empty."""
+	def __init__(self, client, maxsize=DEFAULT_QUEUE_SIZE, policy=BLOCK, resilient=False):
+		if policy not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+			raise ValueError('unknown backpressure policy: {0}'.format(policy))
+		self.client = client
+		self.policy = policy
+		self.resilient = resilient
+		self.subscriptions = {}
+		self._queue = asyncio.Queue(maxsize)
+		self._errors = deque()
+		self._failed = asyncio.Event()
+
+	async def subscribe_collection(self, collection_id):
+		stream = await self.client.collection_output_stream(collection_id, self.resilient)
+		return self._subscribe(Subscription(collection_id), stream)
+
+	async def subscribe_device(self, collection_id, device_id):
+		stream = await self.client.device_output_stream(collection_id, device_id, self.resilient)
+		return self._subscribe(Subscription(collection_id, device_id), stream)
+
+	async def unsubscribe(self, sub):
+		# A newer subscription to the same key may have replaced this one.
+		if self.subscriptions.get(sub.key) is sub:
+			del self.subscriptions[sub.key]
+		task, sub._task = sub._task, None
+		if task is None:
+			return
+		task.cancel()
+		await sub.stream.close()
+
+	async def recv(self):
+		while True:
+			if not self._queue.empty():
+				sub, msg = self._queue.get_nowait()
+				break
+			if self._errors:
+				err = self._errors.popleft()
+				if not self._errors:
+					self._failed.clear()
+				raise err
+			item = await self._get()
+			if item is not None:
+				sub, msg = item
+				break
+		sub.depth -= 1
+		return msg
+
+	async def _get(self):
+		# Wait for a message, or for a stream to fail while none arrive.
+		get = asyncio.ensure_future(self._queue.get())
+		failed = asyncio.ensure_future(self._failed.wait())
+		try:
+			await asyncio.wait([get, failed], return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			failed.cancel()
+			if not get.done():
+				# Cancelling takes effect later; the message, if any, stays
+				# queued for the next call.
+				get.cancel()
+				return None
+		return get.result()
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		return await self.recv()
+
+	def stats(self):
+		"""Return a dict of (depth, received, dropped) per subscription key."""
+		return {key: (sub.depth, sub.received, sub.dropped) for key, sub in self.subscriptions.items()}
+
+	async def close(self):
+		for sub in list(self.subscriptions.values()):
+			await self.unsubscribe(sub)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	def _subscribe(self, sub, stream):
+		old = self.subscriptions.get(sub.key)
+		if old is not None:
+			asyncio.ensure_future(self.unsubscribe(old))
+		sub.stream = stream
+		sub._task = asyncio.ensure_future(self._pump(sub))
+		self.subscriptions[sub.key] = sub
+		return sub
+
+	async def _pump(self, sub):
+		try:
+			while True:
+				msg = await sub.stream.recv()
+				sub.received += 1
+				await self._put(sub, msg)
+		except OutputStreamClosed:
+			sub.closed = True
+		except asyncio.CancelledError:
+			raise
+		except Exception as err:
+			sub.closed = True
+			sub.error = err
+			self._errors.append(err)
+			self._failed.set()
+
+	async def _put(self, sub, msg):
+		if self._queue.full():
+			if self.policy == DROP_NEWEST:
+				sub.dropped += 1
+				return
+			if self.policy == DROP_OLDEST:
+				oldest, _ = self._queue.get_nowait()
+				oldest.depth -= 1
+				oldest.dropped += 1
+		sub.depth += 1
+		await self._queue.put((sub, msg))
+
+
+class Subscription:
+	"""A collection or device stream handled by a StreamManager.  depth is the
+	number of its messages waiting in the queue, received and dropped count the
+	messages read from the websocket and discarded by the backpressure policy.
+	closed is set when the stream ended, and error to the exception that ended
+	it unless it was closed."""
+	def __init__(self, collection_id, device_id=None):
+		self.collection_id = collection_id
+		self.device_id = device_id
+		self.key = (collection_id, device_id)
+		self.stream = None
+		self.depth = 0
+		self.received = 0
+		self.dropped = 0
+		self.closed = False
+		self.error = None
+		self._task = None
+
+
+class StreamReader:
+	"""Read the output stream of a collection, or of a device if device_id is
+	given, from synchronous code.  The websocket is read on a background thread
+	running its own event loop, which hands messages over in batches through a
+	buffer of about maxsize messages; when the buffer is full the thread stops
+	reading until there is room.  client is an nbiot.Client.
+
+	recv and recv_many take a timeout in seconds; iterating over the reader
+	yields messages until the stream ends.  Once the stream has ended and the
+	buffer is drained they raise OutputStreamClosed, or the error that ended
+	the stream.  close stops the thread."""
+	def __init__(self, client, collection_id, device_id=None, resilient=False, maxsize=DEFAULT_QUEUE_SIZE):
+		if device_id is None:
+			open = lambda: client.collection_output_stream(collection_id, resilient)
+		else:
+			open = lambda: client.device_output_stream(collection_id, device_id, resilient)
+		self.maxsize = maxsize
+		self._buffer = deque()
+		self._cond = threading.Condition()
+		self._closed = False
+		self._done = False
+		self._error = None
+		self._connected = threading.Event()
+		self._loop = asyncio.new_event_loop()
+		self._task = None
+		self._reading = False
+		self._thread = threading.Thread(target=self._run, args=(open,), name='nbiot-stream-reader', daemon=True)
+		self._thread.start()
+		self._connected.wait()
+		if self._error is not None:
+			self._thread.join()
+			raise self._error
+
+	def recv(self, timeout=None):
+		"""Return the next message, waiting up to timeout seconds (without limit
+		if None).  Raises TimeoutError if none arrived in time."""
+		with self._cond:
+			self._wait(timeout)
+			if not self._buffer:
+				raise TimeoutError()
+			self._cond.notify_all()
+			return self._buffer.popleft()
+
+	def recv_many(self, max_n=DEFAULT_BATCH_SIZE, timeout=None):
+		"""Return up to max_n of the messages received so far, waiting up to
+		timeout seconds for the first one.  Returns an empty list on timeout."""
+		with self._cond:
+			self._wait(timeout)
+			buffer = self._buffer
+			msgs = [buffer.popleft() for _ in range(min(max_n, len(buffer)))]
+			self._cond.notify_all()
+			return msgs
+
+	def _wait(self, timeout):
+		self._cond.wait_for(lambda: self._buffer or self._done, timeout)
+		if not self._buffer and self._done:
+			if self._error is not None and not self._closed:
+				raise self._error
+			raise OutputStreamClosed()
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		try:
+			return self.recv()
+		except OutputStreamClosed:
+			raise StopIteration
+
+	def close(self):
+		with self._cond:
+			self._closed = True
+			self._buffer.clear()
+			self._cond.notify_all()
+		try:
+			self._loop.call_soon_threadsafe(self._stop)
+		except RuntimeError:
+			# The loop already finished.
+			pass
+		self._thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _run(self, open):
+		asyncio.set_event_loop(self._loop)
+		try:
+			self._loop.run_until_complete(self._pump(open))
+		finally:
+			self._loop.close()
+
+	async def _pump(self, open):
+		try:
+			stream = await open()
+		except Exception as err:
+			self._error = err
+			self._done = True
+			self._connected.set()
+			return
+		self._task = asyncio.current_task()
+		self._connected.set()
+		try:
+			while True:
+				self._reading = True
+				msgs = await stream.recv_many()
+				self._reading = False
+				if not self._put(msgs):
+					break
+		except (OutputStreamClosed, asyncio.CancelledError):
+			pass
+		except Exception as err:
+			self._error = err
+		finally:
+			await stream.close()
+			with self._cond:
+				self._done = True
+				self._cond.notify_all()
+
+	def _stop(self):
+		# Only interrupt the pump while it waits for the websocket, so that it
+		# can still close the stream cleanly.
+		if self._reading:
+			self._task.cancel()
+
+	def _put(self, msgs):
+		with self._cond:
+			# Blocking the loop is fine: this thread serves only the one stream,
+			# and while it waits the websocket applies backpressure to the server.
+			self._cond.wait_for(lambda: len(self._buffer) < self.maxsize or self._closed)
+			if self._closed:
+				return False
+			self._buffer.extend(msgs)
+			self._cond.notify_all()
+			return True
@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+
+from nbiot import nbiot
+from nbiot import streams
+
+class Stream:
+	def __init__(self, n, error=None, delay=0):
+		self.msgs = [nbiot.OutputDataMessage(payload=bytes([i]), received=i) for i in range(n)]
+		self.error = error
+		self.delay = delay
+		self.closed = asyncio.Event()
+
+	async def recv(self):
+		if self.msgs:
+			return self.msgs.pop(0)
+		if self.error is not None:
+			await asyncio.sleep(self.delay)
+			raise self.error
+		await self.closed.wait()
+		raise nbiot.OutputStreamClosed()
+
+	async def close(self):
+		self.closed.set()
+
+class Client:
+	def __init__(self, n, error=None, delay=0):
+		self.n = n
+		self.error = error
+		self.delay = delay
+		self.streams = []
+
+	async def collection_output_stream(self, id, resilient=False):
+		self.streams.append(Stream(self.n, self.error, self.delay))
+		return self.streams[-1]
+
+	async def device_output_stream(self, collection_id, device_id, resilient=False):
+		self.streams.append(Stream(self.n, self.error, self.delay))
+		return self.streams[-1]
+
+@pytest.mark.asyncio
+async def test_stream_manager():
+	async with streams.StreamManager(Client(5)) as manager:
+		a = await manager.subscribe_collection('1')
+		b = await manager.subscribe_device('1', '2')
+		got = [await manager.recv() for _ in range(10)]
+		assert len(got) == 10
+		assert manager.stats() == {a.key: (0, 5, 0), b.key: (0, 5, 0)}
+
+		await manager.unsubscribe(b)
+		assert list(manager.stats()) == [a.key]
+
+@pytest.mark.asyncio
+async def test_stream_manager_resubscribe():
+	client = Client(0)
+	async with streams.StreamManager(client) as manager:
+		await manager.subscribe_collection('1')
+		sub = await manager.subscribe_collection('1')
+		await asyncio.sleep(0)
+		assert manager.subscriptions == {sub.key: sub}
+		assert [s.closed.is_set() for s in client.streams] == [True, False]
+	assert all(s.closed.is_set() for s in client.streams)
+
+@pytest.mark.asyncio
+async def test_stream_manager_error():
+	error = nbiot.ClientError(http_status_code=401, message='unauthorized')
+	async with streams.StreamManager(Client(2, error)) as manager:
+		sub = await manager.subscribe_collection('1')
+		assert [(await manager.recv()).payload for _ in range(2)] == [b'\x00', b'\x01']
+		with pytest.raises(nbiot.ClientError):
+			await asyncio.wait_for(manager.recv(), 1)
+		assert sub.closed and sub.error is error
+
+	# The stream fails while recv is already waiting for a message.
+	async with streams.StreamManager(Client(0, error, delay=0.1)) as manager:
+		sub = await manager.subscribe_collection('1')
+		with pytest.raises(nbiot.ClientError):
+			await asyncio.wait_for(manager.recv(), 1)
+		assert sub.error is error
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('policy, first', [(streams.DROP_OLDEST, 2), (streams.DROP_NEWEST, 0)])
+async def test_stream_manager_drop(policy, first):
+	async with streams.StreamManager(Client(5), maxsize=3, policy=policy) as manager:
+		sub = await manager.subscribe_collection('1')
+		while sub.received < 5:
+			await asyncio.sleep(0)
+		assert sub.depth == 3 and sub.dropped == 2
+		msg = await manager.recv()
+		assert msg.payload == bytes([first])
+
+def test_stream_reader(server):
+	if server is None:
+		pytest.skip('needs the fake server to inject messages')
+	client = nbiot.Client()
+	collection = client.create_collection(nbiot.Collection())
+	try:
+		device = client.create_device(collection.id, nbiot.Device(imsi='reader', imei='reader'))
+		with streams.StreamReader(client, collection.id, maxsize=10) as reader:
+			with pytest.raises(TimeoutError):
+				reader.recv(timeout=0.01)
+			assert reader.recv_many(timeout=0.01) == []
+
+			done = server.generate(collection.id, rate=float('inf'), count=100, payload=b'x', device_ids=[device.id])
+			msgs = [reader.recv(timeout=5)]
+			while len(msgs) < 100:
+				batch = reader.recv_many(7, timeout=5)
+				assert 0 < len(batch) <= 7
+				msgs += batch
+			done.result()
+			assert len(reader._buffer) == 0
+			assert all(m.device_id == device.id for m in msgs)
+
+			server.inject(collection.id, device.id, b'last')
+			server.drop_streams()
+			assert [m.payload for m in reader] == [b'last']
+			with pytest.raises(nbiot.OutputStreamClosed):
+				reader.recv_many()
+
+		reader = streams.StreamReader(client, collection.id, device.id, maxsize=10)
+		server.generate(collection.id, rate=float('inf'), count=1000, payload=b'x', device_ids=[device.id]).result()
+		reader.close()
+		assert not reader._thread.is_alive()
+		with pytest.raises(nbiot.OutputStreamClosed):
+			reader.recv()
+	finally:
+		client.delete_collection(collection.id)
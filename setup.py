@@ -128,7 +128,9 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
         'requests>=2.20.0',
-        'websockets',
+        'urllib3>=1.26',
+        # OutputStream reads the frame queue of the legacy protocol.
+        'websockets<14',
     ],  # Optional
 
     # List additional groups of dependencies here (e.g. development
@@ -140,6 +142,9 @@ setup(
     # Similar to `install_requires` above, these must be valid existing
     # projects.
     extras_require={  # Optional
+        'async': ['aiohttp'],
+        'fast': ['orjson'],
+        'export': ['pyarrow', 'pytz; python_version < "3.8"'],
     },
 
     python_requires='>=3.7',
@@ -167,6 +172,9 @@ setup(
     # For example, the following would provide a command called `sample` which
     # executes the function `main` from this package when invoked:
     entry_points={  # Optional
+        'console_scripts': [
+            'nbiot=nbiot.cli:main',
+        ],
     },
 
     # List additional URLs that are relevant to your project as a dict.